@@ -1,11 +1,14 @@
 package com.example.controller;
 
+import android.os.SystemClock;
 import android.util.Log;
 import androidx.annotation.Nullable;
 
 import com.google.gson.Gson;
 
 import java.io.IOException;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
 import java.util.concurrent.TimeUnit;
 
 import okhttp3.Call;
@@ -16,6 +19,7 @@ import okhttp3.Response;
 import okhttp3.ResponseBody;
 import okhttp3.WebSocket;
 import okhttp3.WebSocketListener;
+import okio.ByteString;
 
 public class NetworkClient {
 
@@ -35,6 +39,13 @@ public class NetworkClient {
     private WebSocket telemetrySocket;
     private TelemetryListener telemetryListener;
 
+    // 二进制摇杆帧 (对应 drone_server.py 的 JOY_STRUCT_FMT '<BBHhhhhI', 16 字节)
+    private static final byte JOY_TAG = 0x4A;
+    private static final int JOY_FRAME_SIZE = 16;
+    private final ByteBuffer joyBuf = ByteBuffer.allocate(JOY_FRAME_SIZE).order(ByteOrder.LITTLE_ENDIAN);
+    private int joySeq = 0;
+    private boolean binaryJoystick = true;
+
     public NetworkClient() {
         httpClient = new OkHttpClient.Builder()
                 .connectTimeout(5, TimeUnit.SECONDS)
@@ -50,6 +61,11 @@ public class NetworkClient {
         telemetryListener = l;
     }
 
+    // false 时回退为 JSON 摇杆消息 (兼容旧版服务器)
+    public void setBinaryJoystick(boolean enabled) {
+        binaryJoystick = enabled;
+    }
+
     public void getStatus(SimpleCallback cb) {
         if (baseUrl == null) {
             cb.onResult(false, "baseUrl == null");
@@ -76,7 +92,8 @@ public class NetworkClient {
     public void openControlSocket() {
         if (baseUrl == null) return;
         Request req = new Request.Builder()
-                .url(baseUrl.replaceFirst("^http", "ws") + "/ws/control")
+                // 摇杆只需周期性累计确认, 减少控制链路上的应答消息
+                .url(baseUrl.replaceFirst("^http", "ws") + "/ws/control?ack=cumulative")
                 .build();
         controlSocket = httpClient.newWebSocket(req, new WebSocketListener() {
             @Override public void onOpen(WebSocket webSocket, Response response) {
@@ -108,10 +125,34 @@ public class NetworkClient {
 
     public void sendJoystick(float vx, float vy, float vz, float yawRate) {
         if (controlSocket == null) return;
+        if (binaryJoystick) {
+            controlSocket.send(encodeJoystick(vx, vy, vz, yawRate));
+            return;
+        }
         JoystickMsg msg = new JoystickMsg(vx, vy, vz, yawRate);
         controlSocket.send(gson.toJson(msg));
     }
 
+    // seq + 四轴 (mm/s, mrad/s) + 客户端时间戳 (ms)
+    private ByteString encodeJoystick(float vx, float vy, float vz, float yawRate) {
+        joySeq = (joySeq + 1) & 0xFFFF;
+        joyBuf.clear();
+        joyBuf.put(JOY_TAG)
+              .put((byte) 0)
+              .putShort((short) joySeq)
+              .putShort(toMilli(vx))
+              .putShort(toMilli(vy))
+              .putShort(toMilli(vz))
+              .putShort(toMilli(yawRate))
+              .putInt((int) SystemClock.elapsedRealtime());
+        return ByteString.of(joyBuf.array(), 0, JOY_FRAME_SIZE);
+    }
+
+    private static short toMilli(float v) {
+        int m = Math.round(v * 1000f);
+        return (short) Math.max(Short.MIN_VALUE, Math.min(Short.MAX_VALUE, m));
+    }
+
     public void sendMode(String mode) {
         if (controlSocket == null) return;
         ModeMsg msg = new ModeMsg(mode);
@@ -49,6 +49,7 @@ if pgrep -f "drone_server.py" > /dev/null; then
     if netstat -tuln 2>/dev/null | grep -q ":8000"; then
         echo "   ✅ 端口 8000 已监听"
         echo "   🎮 状态接口: http://${MY_IP}:8000/api/status"
+        echo "   📈 指标接口: http://${MY_IP}:8000/metrics"
     else
         echo "   ⚠️  端口 8000 未监听"
     fi
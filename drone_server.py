@@ -3,22 +3,51 @@
 # 简化打印调试版 WebSocket/HTTP Drone Server (Python 2.7 兼容)
 #
 # 功能:
-#   - 连接飞控 (DroneKit)
-#   - HTTP /api/status 获取基础状态
+#   - 连接飞控 (DroneKit): 后台线程连接, 失败指数退避重试; HTTP/WS 启动后立即可用,
+#     连接进度在状态/遥测的 link 字段中 (connecting / retry_wait / connected)
+#     只等待 mode / armed / 位置 (CONNECT_WAIT_READY), 参数表先从磁盘缓存加载
+#     (按飞控板 / 固件标识分文件, 以参数个数校验), 仅作临时值; DroneKit 后台下载的完整参数表逐个覆盖并写回缓存
+#     连接后由 link_supervisor 监视心跳, 超过 HEARTBEAT_TIMEOUT 未收到则断开并重连 (客户端会话保持不变),
+#     link 字段另含 reconnects (重连次数) / last_outage_s (上次断链到恢复的秒数)
+#   - 链路质量: 按组件统计 MAVLink 序号缺口 (丢包)、心跳间隔抖动、收发字节率、RADIO_STATUS,
+#     最近 LINK_STATS_WINDOW 秒的滚动统计在遥测 link_quality 字段中, 累计计数 / 各组件明细在 HTTP /api/metrics
+#   - 控制延迟追踪: 摇杆帧携带客户端时间戳 (二进制帧 client_ts_ms / JSON "ts"), 分段统计
+#     uplink (客户端 -> 服务器, 相对最小时钟差) / server (收到 -> 设定点发出) /
+#     autopilot (TIMESYNC 往返的一半), 直方图在遥测 latency 字段与 /api/metrics 中
+#   - HTTP /metrics: Prometheus 文本格式 (控制循环频率/抖动、遥测分发耗时、客户端数、
+#     指令耗时、MAVLink 消息计数、IOLoop 延迟等); 计数只在各自线程内累加, 抓取时才汇总
+#   - HTTP /api/status 获取基础状态 (带 version; ETag 为状态版本号, 未变化时返回 304, 支持 gzip;
+#                     数值在 TELEM_DEADBANDS 死区内的抖动不算变化)
+#          /api/status?wait=<version> 长轮询: 版本变化 (或 STATUS_LONGPOLL_TIMEOUT) 后才返回
+#          /api/events SSE: 每个新状态版本推送一次 (event: status, id: version)
 #   - WebSocket:
 #       /ws/control   接收控制指令 (arm / disarm / mode / takeoff / land / joystick)
 #       /ws/telemetry 推送遥测 (mode / armed / altitude / groundspeed / heading / battery / 延迟等)
-#   - 简单速度控制: 发送 NED 速度指令 (GUIDED 模式)
+#                     ?delta=1 时只推送超过死区的变化字段, 并周期性发送关键帧
+#                     发送 {"type":"subscribe","fields":{"attitude":50,"battery":1}} 按字段/频率订阅
+#                     发送 {"type":"stream","messages":["ATTITUDE"]} 逐条转发飞控高频消息 (带 time_boot_ms)
+#       两个 WebSocket 均支持 ?enc=json|msgpack|struct 协商编码 (默认 json)
+#       /ws/control 另支持 16 字节二进制摇杆帧 (见 JOY_STRUCT_FMT), 不经过 JSON
+#                   ?ack=cumulative 时不再逐条应答摇杆, 每 JOY_ACK_INTERVAL 确认最新 seq, 仅拒绝时立即 NACK
+#                   ?frame=local|body&yaw_rate=0|1 选择摇杆速度坐标系 / 是否启用 yaw_rate (每个会话独立),
+#                   也可发送 {"type":"setpoint","frame":"body","yaw_rate":true} 随时切换
+#   - 可选 UDP 控制通道 (DRONE_UDP_PORT): 仅 joystick / brake, 先在 /ws/control 发送
+#     {"type":"udp_session"} 取得 token; mode / arm / takeoff 等仍走 WebSocket
+#   - 简单速度控制: 发送 NED 速度指令 (GUIDED 模式), 由 SetpointPacker 预分配缓冲区直接打包
 #   - takeoff: 使用 simple_takeoff + watcher
 #   - 失败调试: ensure_mode / arm 失败时打印可能阻塞信息 + 最近 STATUSTEXT
+#   - 指令执行器: mode / arm / disarm / takeoff / land 在后台线程执行,
+#     先回复 {"type":"accepted","cmd_id":N}, 完成后再推送 {"type":"ack","cmd_id":N,"ok":...}
 #
 # 说明:
 #   1. 尽量保持最少依赖和 Python 2.7 语法 (无 f-string, 无 daemon=)
 #   2. 如果要在室内无 GPS 测试，可自行在 takeoff 处启用 GUIDED_NOGPS 回退（已注释）
-#   3. 速度指令默认 10Hz；若 0.5s 内未收到摇杆消息则自动清零
+#   3. 速度指令默认 20Hz (CONTROL_HZ, 绝对截止时间调度)；若 0.5s 内未收到摇杆消息则自动清零
+#      摇杆命令变化时立即转发给飞控 (最高 JOY_FORWARD_MAX_HZ), control_loop 只负责保活与超时清零
 #
 # 依赖:
 #   pip install dronekit tornado pymavlink
+#   可选: pip install msgpack (enc=msgpack / enc=struct 的非热点消息)
 #
 # 启动:
 #   python drone_server.py
@@ -26,18 +55,44 @@
 # 环境变量:
 #   DRONE_CONN (例如 /dev/ttyUSB0 或 udp:127.0.0.1:14550)
 #   DRONE_BAUD (默认 921600, 仅串口)
+#   DRONE_SERVER_PORT (默认 8000)
+#   DRONE_CONTROL_HZ (速度指令频率, 默认 20)
+#   DRONE_JOY_FORWARD_HZ (摇杆即时转发最高频率, 默认 50; 0 = 关闭, 仅由 control_loop 发送)
+#   DRONE_UDP_PORT (UDP 控制通道端口, 默认 0 = 关闭)
+#   DRONE_PARAM_CACHE (参数表缓存目录, 默认 ~/.drone_server/params; 空 = 不使用缓存)
 #
 # 注意安全:
 #   仅在测试与可控环境使用；请依据实际飞行法规与安全规范操作。
 
 from __future__ import print_function
 import os
+import re
 import time
+import errno
+import socket
+import binascii
 import json
 import math
+import struct
+import bisect
 import threading
 import collections
-
+import zlib
+import datetime
+
+try:
+    import Queue as queue  # Python 2
+except ImportError:
+    import queue
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import tornado.concurrent
+import tornado.escape
+import tornado.gen
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
@@ -45,42 +100,202 @@ import tornado.websocket
 from dronekit import connect, VehicleMode, LocationGlobalRelative
 
 # ========== 全局 ==========
-vehicle = None
+# Tornado 主 IOLoop (main() 中设置, 供后台线程 add_callback 使用)
+ioloop = None
 
 # 控制 & 遥测客户端集合
 control_clients = set()
 telemetry_clients = set()
+# 订阅了 MAVLink 高频消息流的遥测客户端
+stream_clients = set()
+
+# 速度设定点的坐标系与 type_mask (SET_POSITION_TARGET_LOCAL_NED)
+MAV_FRAME_LOCAL_NED = 1
+MAV_FRAME_BODY_OFFSET_NED = 9   # 水平速度相对机头方向
+VELOCITY_TYPE_MASK = 0b0000111111000111           # 只启用速度分量
+VELOCITY_YAW_RATE_TYPE_MASK = 0b0000011111000111  # 速度 + yaw_rate
+SETPOINT_FRAMES = {"local": MAV_FRAME_LOCAL_NED, "body": MAV_FRAME_BODY_OFFSET_NED}
+
+# 速度设定点 (不可变, 可直接比较是否变化)
+VelocityCmd = collections.namedtuple('VelocityCmd', 'vx vy vz yaw_rate frame type_mask')
+ZERO_VELOCITY_CMD = VelocityCmd(0.0, 0.0, 0.0, 0.0, MAV_FRAME_LOCAL_NED, VELOCITY_TYPE_MASK)
+# 最近一次摇杆命令及其接收时间 (time.time, 0 = 从未收到)
+JoystickState = collections.namedtuple('JoystickState', 'cmd ts')
+# 最近一次实际发出的速度设定点 (ts 为 monotonic; forward = 由即时转发发出)
+SentSetpoint = collections.namedtuple('SentSetpoint', 'cmd ts forward')
+# 起飞 / 降落过程标志
+FlightState = collections.namedtuple('FlightState', 'takeoff_in_progress takeoff_target_alt landing_in_progress')
+# 飞控链路: state = connecting / retry_wait / connected / lost; attempt 为本轮连接尝试次数;
+# since 为进入该状态的时间; reconnects 为断链后重连成功的次数; last_outage_s 为上次断链到恢复的秒数
+LinkStatus = collections.namedtuple('LinkStatus', 'state attempt since error reconnects last_outage_s')
+
+class SharedState(object):
+    """
+    IOLoop / control_loop / telemetry_loop / 指令执行器 / takeoff watcher 共享的状态.
+    每个属性都是不可变对象, 更新时整体替换 (单次属性赋值是原子的):
+    读方取一次引用即得到一组一致的值 (例如摇杆命令与其时间戳), 热路径不加锁.
+    flight 有多个写线程, 读-改-写经 update_flight 串行化.
+    """
+
+    def __init__(self):
+        self.vehicle = None
+        self.joystick = JoystickState(ZERO_VELOCITY_CMD, 0.0)   # 仅 IOLoop 线程写
+        self.sent = SentSetpoint(None, 0.0, False)               # 持有 setpoint_lock 时写
+        self.flight = FlightState(False, None, False)
+        self.link = LinkStatus("connecting", 0, time.time(), None, 0, None)   # 仅 link_supervisor 写
+        self.heartbeat = 0.0    # 最近一次飞控 HEARTBEAT (monotonic), 仅 DroneKit 消息线程写
+        self._flight_lock = threading.Lock()
 
-# 最近一次摇杆命令
-last_velocity_cmd = {"vx": 0.0, "vy": 0.0, "vz": 0.0, "yaw_rate": 0.0}
-last_joystick_time = 0.0
+    def update_flight(self, **changes):
+        with self._flight_lock:
+            self.flight = self.flight._replace(**changes)
+        status_watchers.refresh_soon()
 
-# Takeoff 过程标志
-takeoff_in_progress = False
-takeoff_target_alt = None
+    def set_link(self, link_state, attempt, error=None, **extra):
+        self.link = self.link._replace(state=link_state, attempt=attempt, since=time.time(),
+                                       error=error, **extra)
+        status_watchers.refresh_soon()
 
-# Landing 过程标志
-landing_in_progress = False
+state = SharedState()
+
+# 发送速度设定点时持有 (control_loop 与摇杆即时转发共用同一条链路)
+setpoint_lock = threading.Lock()
 
 # 保存最近 STATUSTEXT
 recent_statustext = collections.deque(maxlen=50)
 
 # 速度控制频率 / 超时
-CONTROL_HZ = 20.0
+CONTROL_HZ = float(os.environ.get("DRONE_CONTROL_HZ", "20"))
 VELOCITY_TIMEOUT = 0.5  # s
+# cmd_age_ms 超过 VELOCITY_TIMEOUT 后报告的固定值 (= 摇杆命令已过期)
+CMD_AGE_STALE_MS = int(VELOCITY_TIMEOUT * 1000)
+# control_loop 抖动/频率统计窗口
+CONTROL_STATS_WINDOW = 1.0  # s
+# 接受速度设定点的模式
+VELOCITY_MODES = ("GUIDED", "GUIDED_NOGPS", "BRAKE", "POSHOLD")
+# 摇杆即时转发的最高频率 (0 = 关闭)
+JOY_FORWARD_MAX_HZ = float(os.environ.get("DRONE_JOY_FORWARD_HZ", "50"))
 
 # Telemetry 发送间隔
 TELEM_INTERVAL = 0.5  # s
 
+# /api/status / diag 复用快照的最大年龄 (telemetry_loop 每个 tick 刷新)
+STATUS_MAX_AGE = TELEM_INTERVAL * 2  # s
+# /api/status 响应体不小于该字节数且客户端接受 gzip 时返回预压缩版本 (0 = 关闭)
+STATUS_GZIP_MIN = 256
+# /api/status?wait= 长轮询最长挂起时间; /api/events 无变化时的保活注释间隔
+STATUS_LONGPOLL_TIMEOUT = 25.0  # s
+SSE_KEEPALIVE = 15.0  # s
+
+# 每个遥测客户端允许的未写完帧数; 超过后只保留最新一帧 (latest-wins), 旧帧丢弃
+TELEM_MAX_INFLIGHT = 2
+
+# 增量遥测 (/ws/telemetry?delta=1): 关键帧间隔与各字段死区 (变化不超过死区则不发送)
+TELEM_KEYFRAME_INTERVAL = 5.0  # s
+TELEM_DEADBANDS = {
+    "altitude": 0.02,          # m
+    "groundspeed": 0.05,       # m/s
+    "heading": 1.0,            # deg
+    "attitude.roll": 0.005,    # rad
+    "attitude.pitch": 0.005,   # rad
+    "attitude.yaw": 0.005,     # rad
+    "battery.voltage": 0.05,   # V
+    "battery.current": 0.1,    # A
+    "cmd_age_ms": 100,         # ms
+    "link_quality.rx_bps": 500,                  # B/s
+    "link_quality.tx_bps": 500,                  # B/s
+    "link_quality.loss_pct": 1.0,                # %
+    "link_quality.heartbeat.interval_ms": 50,    # ms
+    "link_quality.heartbeat.jitter_ms": 20,      # ms
+    "link_quality.heartbeat.max_ms": 100,        # ms
+    "link_quality.radio.rssi": 3,
+    "link_quality.radio.remrssi": 3,
+    "link_quality.radio.noise": 3,
+    "link_quality.radio.remnoise": 3,
+    "link_quality.radio.txbuf": 10,              # %
+}
+# 不参与比较的字段 (每帧都会变化), 增量帧单独携带 timestamp
+TELEM_DELTA_SKIP = ("type", "timestamp")
+
+# 字段订阅: 允许的频率范围, 以及共享字段缓存的有效期 (同一时刻多个订阅共用一次读取)
+TELEM_SUB_MAX_HZ = 50.0
+TELEM_SUB_MIN_HZ = 0.1
+FIELD_CACHE_TTL = 0.01  # s
+
+# 摇杆速度默认坐标系 (local / body) 与是否启用 yaw_rate (客户端可用 ?frame= / ?yaw_rate= 覆盖)
+SETPOINT_FRAME = "local"
+SETPOINT_YAW_RATE = False
+
+# 摇杆应答模式: each = 每条摇杆消息一个 ack; cumulative = 周期性确认最新 seq (客户端可用 ?ack= 覆盖)
+JOY_ACK_MODE = "each"
+JOY_ACK_INTERVAL = 0.2  # s
+
 # 默认起飞高度
 DEFAULT_TAKEOFF_ALT = 1.5
 
+# 连接飞控: DroneKit connect 超时, 失败后的重试间隔 (指数退避, 上限 CONNECT_RETRY_MAX)
+CONNECT_TIMEOUT = 120  # s
+# connect 只等待服务器实际需要的属性 (心跳由 connect 本身等待), 不等完整参数表下载
+CONNECT_WAIT_READY = ['mode', 'armed', 'location.global_relative_frame']
+CONNECT_RETRY_MIN = 1.0  # s
+CONNECT_RETRY_MAX = 30.0  # s
+
+# 链路监护: 超过 HEARTBEAT_TIMEOUT 未收到飞控心跳视为断链 (ArduPilot 默认 1Hz 心跳); 检查间隔
+HEARTBEAT_TIMEOUT = 3.0  # s
+LINK_CHECK_INTERVAL = 0.5  # s
+# 断链后等待旧连接关闭 (读线程退出、端口释放) 的上限
+LINK_CLOSE_TIMEOUT = 5.0  # s
+MAV_AUTOPILOT_INVALID = 8  # GCS / 伴随计算机等非飞控组件的 HEARTBEAT
+
+# 链路质量: 滚动统计窗口, 保留的心跳间隔个数
+LINK_STATS_WINDOW = 5.0  # s
+LINK_HEARTBEAT_SAMPLES = 30
+
+# 控制延迟追踪: 直方图桶上界 (ms), 分位数统计保留的最近样本数, TIMESYNC 间隔 (0 = 不测飞控段)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# /metrics 其他直方图的桶上界 (ms): 控制循环 tick 滞后 / 遥测分发与 IOLoop 延迟 / 飞控指令耗时
+CONTROL_LATE_BUCKETS_MS = (0.1, 0.5, 1, 2, 5, 10, 20, 50)
+IOLOOP_BUCKETS_MS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 500)
+COMMAND_BUCKETS_MS = (100, 250, 500, 1000, 2000, 5000, 10000, 30000)
+# IOLoop 延迟探测间隔
+IOLOOP_LAG_INTERVAL = 0.5  # s
+LATENCY_RECENT = 256
+LATENCY_TIMESYNC_INTERVAL = 1.0  # s
+# 客户端时钟差取最近两个窗口内的最小值, 跟随时钟漂移
+LATENCY_CLOCK_WINDOW = 10.0  # s
+
+# 参数表缓存目录 (空 = 关闭), 以及等待飞控回复 AUTOPILOT_VERSION / PARAM_VALUE 的超时
+PARAM_CACHE_DIR = os.environ.get("DRONE_PARAM_CACHE",
+                                 os.path.join(os.path.expanduser("~"), ".drone_server", "params"))
+PARAM_PROBE_TIMEOUT = 3.0  # s
+MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES = 520
+
+# 需要飞控链路的指令, 未连接时直接拒绝
+VEHICLE_COMMANDS = ("mode", "arm", "disarm", "takeoff", "land", "brake")
+
+# 指令执行器工作线程数 (1 = 飞控指令按顺序串行执行)
+COMMAND_WORKERS = 1
+
+# 等待 mode / armed 变化时的兜底复查间隔 (正常由属性监听立即唤醒)
+STATE_WAIT_RECHECK = 0.5  # s
+
 # ========== 工具函数 ==========
 
 def log(msg):
     print("[SERVER] %s" % msg)
 
+# 单调时钟 (Python 2 没有 time.monotonic, 退回 time.time)
+monotonic = getattr(time, "monotonic", time.time)
+
+def call_on_ioloop(fn, *args):
+    """从任意线程把回调投递到 IOLoop 线程执行 (add_callback 是线程安全的)"""
+    if ioloop is not None:
+        ioloop.add_callback(fn, *args)
+    else:
+        fn(*args)
+
 def safe_alt():
+    vehicle = state.vehicle
     try:
         if vehicle and vehicle.location and vehicle.location.global_relative_frame:
             a = vehicle.location.global_relative_frame.alt
@@ -90,64 +305,167 @@ def safe_alt():
         pass
     return 0.0
 
-def get_basic_status():
-    """简单状态字典（用于打印/HTTP）"""
-    if not vehicle:
-        return {}
-    st = {}
-    try:
-        st['mode'] = vehicle.mode.name
-    except:
-        st['mode'] = None
-    try:
-        st['armed'] = vehicle.armed
-    except:
-        st['armed'] = None
-    try:
-        st['is_armable'] = vehicle.is_armable
-    except:
-        st['is_armable'] = None
-    try:
-        st['ekf_ok'] = vehicle.ekf_ok
-    except:
-        st['ekf_ok'] = None
-    try:
-        gps = vehicle.gps_0
-        st['gps_fix'] = getattr(gps, 'fix_type', None)
-        st['satellites'] = getattr(gps, 'satellites_visible', None)
-    except:
-        st['gps_fix'] = None
-        st['satellites'] = None
-    st['altitude'] = safe_alt()
-    try:
-        st['groundspeed'] = vehicle.groundspeed
-    except:
-        st['groundspeed'] = None
-    try:
-        st['heading'] = vehicle.heading
-    except:
-        st['heading'] = None
-    # 添加姿态信息
-    try:
-        if hasattr(vehicle, 'attitude'):
-            st['attitude'] = {
-                'roll': vehicle.attitude.roll,
-                'pitch': vehicle.attitude.pitch,
-                'yaw': vehicle.attitude.yaw
-            }
-    except:
-        st['attitude'] = None
+def firmware_version(v):
+    """固件版本字符串; 尚未收到 AUTOPILOT_VERSION 时 str(v.version) 会抛异常, 返回 None"""
     try:
-        st['battery'] = {
-            "voltage": vehicle.battery.voltage,
-            "current": vehicle.battery.current,
-            "level": vehicle.battery.level
-        }
-    except:
-        st['battery'] = None
-    st['takeoff_in_progress'] = takeoff_in_progress
-    st['takeoff_target_alt'] = takeoff_target_alt
-    st['landing_in_progress'] = landing_in_progress
+        return str(v.version)
+    except Exception:
+        return None
+
+def finite_float(v):
+    """客户端数值 -> float; 非数字或 NaN / Inf (json.loads 接受 NaN / Infinity) 抛 ValueError"""
+    if isinstance(v, bool):
+        raise ValueError("需要数字: %r" % (v,))
+    f = float(v)
+    if math.isnan(f) or math.isinf(f):
+        raise ValueError("需要有限数值: %r" % (v,))
+    return f
+
+def parse_bool(v):
+    """客户端开关量: true/false, 1/0 及其字符串形式 (不区分大小写); 其他值抛 ValueError"""
+    if isinstance(v, bool):
+        return v
+    if v in (0, 1) and not isinstance(v, float):
+        return bool(v)
+    if isinstance(v, (type(u""), str)):
+        t = v.strip().lower()
+        if t in ("1", "true"):
+            return True
+        if t in ("0", "false"):
+            return False
+    raise ValueError("需要布尔值 (true/false/1/0): %r" % (v,))
+
+def cmd_age_ms():
+    """
+    距最近一次摇杆命令的毫秒数, 从未收到时为 -1.
+    超过 VELOCITY_TIMEOUT (命令已过期, control_loop 已清零) 后固定为 CMD_AGE_STALE_MS,
+    不再逐 tick 增长, 增量遥测在无摇杆时保持安静.
+    """
+    ts = state.joystick.ts
+    if ts <= 0:
+        return -1
+    return min(int((time.time() - ts) * 1000), CMD_AGE_STALE_MS)
+
+# ========== 飞控状态记录 ==========
+
+class VehicleRecord(object):
+    """
+    飞控状态的紧凑记录 (__slots__), 由 DroneKit 属性监听在消息线程中逐字段增量更新.
+    get_basic_status / 字段订阅只读这里, 高频轮询 /api/status 不再访问 DroneKit 属性.
+    每个字段单独赋值 (原子), attitude / battery 整体替换为新 dict, 不就地修改.
+    """
+
+    __slots__ = ('mode', 'armed', 'is_armable', 'ekf_ok', 'gps_fix', 'satellites',
+                 'altitude', 'groundspeed', 'heading', 'attitude', 'battery')
+
+    # DroneKit 属性名 -> 更新方法
+    LISTENERS = {
+        'mode': '_on_mode',
+        'armed': '_on_armed',
+        'ekf_ok': '_on_ekf_ok',
+        'gps_0': '_on_gps',
+        'location.global_relative_frame': '_on_location',
+        'groundspeed': '_on_groundspeed',
+        'heading': '_on_heading',
+        'attitude': '_on_attitude',
+        'battery': '_on_battery',
+    }
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.altitude = 0.0     # 与 safe_alt 一致: 未知时为 0
+
+    def attach(self, v):
+        """全量读取一次作为初值, 之后由属性监听增量更新"""
+        self.refresh(v)
+        for name in self.LISTENERS:
+            v.add_attribute_listener(name, self._listener)
+
+    def refresh(self, v):
+        for name in ('mode', 'armed', 'ekf_ok', 'gps_0', 'location.global_relative_frame',
+                     'groundspeed', 'heading', 'attitude', 'battery'):
+            try:
+                value = v
+                for part in name.split('.'):
+                    value = getattr(value, part)
+                getattr(self, self.LISTENERS[name])(v, value)
+            except:
+                pass
+
+    def _listener(self, v, name, value):
+        try:
+            getattr(self, self.LISTENERS[name])(v, value)
+        except:
+            pass
+
+    def _update_armable(self, v):
+        # is_armable 由 mode / GPS / EKF 推导, DroneKit 不单独通知
+        try:
+            self.is_armable = v.is_armable
+        except:
+            self.is_armable = None
+
+    def _on_mode(self, v, value):
+        self.mode = value.name
+        self._update_armable(v)
+
+    def _on_armed(self, v, value):
+        self.armed = value
+
+    def _on_ekf_ok(self, v, value):
+        self.ekf_ok = value
+        self._update_armable(v)
+
+    def _on_gps(self, v, value):
+        self.gps_fix = getattr(value, 'fix_type', None)
+        self.satellites = getattr(value, 'satellites_visible', None)
+        self._update_armable(v)
+
+    def _on_location(self, v, value):
+        if value is not None and value.alt is not None:
+            self.altitude = float(value.alt)
+
+    def _on_groundspeed(self, v, value):
+        self.groundspeed = value
+
+    def _on_heading(self, v, value):
+        self.heading = value
+
+    def _on_attitude(self, v, value):
+        self.attitude = {'roll': value.roll, 'pitch': value.pitch, 'yaw': value.yaw}
+
+    def _on_battery(self, v, value):
+        self.battery = {"voltage": value.voltage, "current": value.current, "level": value.level}
+
+vehicle_record = VehicleRecord()
+
+def get_basic_status():
+    """简单状态字典（用于打印/HTTP）, 只读 vehicle_record"""
+    link = dict(state.link._asdict())
+    if not state.vehicle:
+        return {'link': link}
+    rec = vehicle_record
+    st = {
+        'mode': rec.mode,
+        'armed': rec.armed,
+        'is_armable': rec.is_armable,
+        'ekf_ok': rec.ekf_ok,
+        'gps_fix': rec.gps_fix,
+        'satellites': rec.satellites,
+        'altitude': rec.altitude,
+        'groundspeed': rec.groundspeed,
+        'heading': rec.heading,
+        'attitude': rec.attitude,
+        'battery': rec.battery,
+    }
+    flight = state.flight
+    st['takeoff_in_progress'] = flight.takeoff_in_progress
+    st['takeoff_target_alt'] = flight.takeoff_target_alt
+    st['landing_in_progress'] = flight.landing_in_progress
+    st['link'] = link
+    # 参数表仍含磁盘缓存的临时值 (后台下载未完成)
+    st['params_provisional'] = param_cache.provisional
     
     # 添加控制状态指示
     control_status = {
@@ -156,29 +474,66 @@ def get_basic_status():
         "message": ""
     }
     
-    if vehicle and vehicle.armed:
-        try:
-            mode_name = vehicle.mode.name
-            control_status["current_mode"] = mode_name
-            
-            if mode_name in ("GUIDED", "GUIDED_NOGPS", "POSHOLD"):
-                control_status["can_control"] = True
-                control_status["message"] = "摇杆控制已启用"
-            elif mode_name == "LOITER":
-                control_status["can_control"] = False
-                control_status["message"] = "当前在 LOITER 模式，请切换到 GUIDED 模式以启用摇杆控制"
-            elif mode_name == "LAND":
-                control_status["can_control"] = False
-                control_status["message"] = "当前在 LAND 模式，降落过程中摇杆不可用"
-            else:
-                control_status["can_control"] = False
-                control_status["message"] = "当前模式不支持摇杆控制"
-        except:
+    if rec.armed:
+        mode_name = rec.mode
+        control_status["current_mode"] = mode_name
+        if mode_name is None:
             control_status["message"] = "无法获取飞行模式"
+        elif mode_name in ("GUIDED", "GUIDED_NOGPS", "POSHOLD"):
+            control_status["can_control"] = True
+            control_status["message"] = "摇杆控制已启用"
+        elif mode_name == "LOITER":
+            control_status["can_control"] = False
+            control_status["message"] = "当前在 LOITER 模式，请切换到 GUIDED 模式以启用摇杆控制"
+        elif mode_name == "LAND":
+            control_status["can_control"] = False
+            control_status["message"] = "当前在 LAND 模式，降落过程中摇杆不可用"
+        else:
+            control_status["can_control"] = False
+            control_status["message"] = "当前模式不支持摇杆控制"
     
     st['control_status'] = control_status
+    # 只含飞控 / 飞行状态: 整个字典参与 /api/status 版本比较, 控制循环频率等每秒变化的诊断在 /api/metrics
     return st
 
+class StateWaiter(object):
+    """
+    mode / armed 变化通知.
+    DroneKit 属性监听 (由 HEARTBEAT 驱动, 仅在值变化时触发) 调用 notify_all,
+    ensure_mode / arm_vehicle / disarm_vehicle 的等待者在变化到达时立即被唤醒,
+    不再按 0.3~0.5s 轮询. 监听未挂上时退化为每 STATE_WAIT_RECHECK 复查一次.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+
+    def attach(self, v):
+        v.add_attribute_listener('mode', self._listener)
+        v.add_attribute_listener('armed', self._listener)
+
+    def _listener(self, v, name, value):
+        with self._cond:
+            self._cond.notify_all()
+        # 长轮询 / SSE 客户端立即拿到 mode / armed 变化, 不等下一个遥测 tick
+        status_watchers.refresh_soon()
+
+    def wait_for(self, predicate, timeout):
+        """等待 predicate() 为真; 超时返回 False"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                try:
+                    if predicate():
+                        return True
+                except:
+                    pass
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, STATE_WAIT_RECHECK))
+
+state_waiter = StateWaiter()
+
 def print_blockers(prefix):
     """打印阻塞模式切换或解锁的可能因素"""
     st = get_basic_status()
@@ -208,6 +563,7 @@ def ensure_mode(target, attempts=3, wait_each=6.0):
     极简模式切换: 多次尝试, 失败打印阻塞信息.
     返回 True/False
     """
+    vehicle = state.vehicle
     if not vehicle:
         print("ensure_mode(%s): vehicle 不存在" % target)
         return False
@@ -227,18 +583,10 @@ def ensure_mode(target, attempts=3, wait_each=6.0):
             print("[MODE] 赋值 mode 异常: %s" % e)
 
         t0 = time.time()
-        ok = False
-        while time.time() - t0 < wait_each:
-            try:
-                if vehicle.mode.name == target:
-                    ok = True
-                    break
-            except:
-                pass
-            time.sleep(0.5)
+        ok = state_waiter.wait_for(lambda: vehicle.mode.name == target, wait_each)
 
         if ok:
-            print("[MODE] 切换到 %s 成功" % target)
+            print("[MODE] 切换到 %s 成功 (%.3fs)" % (target, time.time() - t0))
             return True
         else:
             print("[MODE] 仍未进入 %s" % target)
@@ -248,6 +596,7 @@ def ensure_mode(target, attempts=3, wait_each=6.0):
     return False
 
 def arm_vehicle():
+    vehicle = state.vehicle
     if not vehicle:
         print("arm: vehicle 不可用")
         return False
@@ -257,16 +606,15 @@ def arm_vehicle():
     print("解锁中...")
     vehicle.armed = True
     t0 = time.time()
-    while not vehicle.armed and time.time() - t0 < 10:
-        time.sleep(0.3)
-    if vehicle.armed:
-        print("解锁成功")
+    if state_waiter.wait_for(lambda: vehicle.armed, 10):
+        print("解锁成功 (%.3fs)" % (time.time() - t0))
         return True
     print("解锁失败")
     print_blockers("解锁失败诊断")
     return False
 
 def disarm_vehicle():
+    vehicle = state.vehicle
     if not vehicle:
         print("disarm: vehicle 不可用")
         return False
@@ -280,79 +628,490 @@ def disarm_vehicle():
     print("上锁中...")
     vehicle.armed = False
     t0 = time.time()
-    while vehicle.armed and time.time() - t0 < 8:
-        time.sleep(0.3)
-    if not vehicle.armed:
-        print("上锁成功")
+    if state_waiter.wait_for(lambda: not vehicle.armed, 8):
+        print("上锁成功 (%.3fs)" % (time.time() - t0))
         return True
     print("上锁失败")
     return False
 
+def _heartbeat_listener(self, name, msg):
+    # 只认飞控自身的心跳, 同一链路上的 GCS 等组件不算
+    if getattr(msg, 'autopilot', None) != MAV_AUTOPILOT_INVALID:
+        now = monotonic()
+        link_quality.heartbeat(now)
+        state.heartbeat = now
+
 def _statustext_listener(self, name, msg):
     txt = getattr(msg, 'text', '').replace('\x00', '')
     recent_statustext.append((time.time(), getattr(msg, 'severity', None), txt))
 
 # ========== 速度指令 (GUIDED) ==========
 
-def send_ned_velocity(vx, vy, vz, yaw_rate=0.0):
+# ========== 设定点快速打包 ==========
+
+# SET_POSITION_TARGET_LOCAL_NED (#84) 的 payload 布局 (按 MAVLink 字段大小排序后, 53 字节):
+#   time_boot_ms, x, y, z, vx, vy, vz, afx, afy, afz, yaw, yaw_rate, type_mask,
+#   target_system, target_component, coordinate_frame
+SPT_LOCAL_NED_FMT = '<I11fHBBB'
+SPT_LOCAL_NED_ID = 84
+SPT_LOCAL_NED_CRC_EXTRA = 143
+SPT_VELOCITY_OFFSET = 16   # vx, vy, vz ('<3f') 在 payload 中的偏移
+SPT_YAW_RATE_OFFSET = 44   # yaw_rate ('<f')
+SPT_TYPE_MASK_OFFSET = 48  # type_mask ('<H')
+SPT_FRAME_OFFSET = 52      # coordinate_frame (uint8, 非 0, MAVLink2 不会截断)
+_SPT_VELOCITY = struct.Struct('<3f')
+_SPT_YAW_RATE = struct.Struct('<f')
+_SPT_TYPE_MASK = struct.Struct('<H')
+_MAV_CRC = struct.Struct('<H')
+
+# MAVLink 的 X.25 CRC 是反射版 CRC-CCITT; binascii.crc_hqx (C 实现) 是非反射版,
+# 输入逐字节位反转、结果 16 位反转后两者等价, 避免在 Python 里逐字节循环
+_BITREV = [int('{0:08b}'.format(i)[::-1], 2) for i in range(256)]
+_BITREV_TABLE = bytes(bytearray(_BITREV))
+
+def x25crc(data, crc_extra=None):
+    """MAVLink CRC-16 (X.25, 初值 0xFFFF); crc_extra 为消息的附加种子字节"""
+    crc = binascii.crc_hqx(bytearray(data).translate(_BITREV_TABLE), 0xFFFF)
+    if crc_extra is not None:
+        crc = binascii.crc_hqx(bytearray((_BITREV[crc_extra],)), crc)
+    return (_BITREV[crc & 0xFF] << 8) | _BITREV[crc >> 8]
+
+class SetpointPacker(object):
     """
-    发送 NED 速度 (m/s). yaw_rate 暂忽略或用后续扩展.
-    仅在 GUIDED 下有效.
+    SET_POSITION_TARGET_LOCAL_NED 专用打包器.
+    绑定时按 pymavlink pack() 的输出预先构造整帧, 之后每次只改写 seq / 速度 / yaw_rate /
+    type_mask / 坐标系和 CRC,
+    直接写入 DroneKit 的发送队列 (mav.file), 不再逐次创建消息对象.
+    绑定时与 pack() 结果逐字节比对; 不一致、启用签名或出现异常时永久退回常规 send_mavlink 路径.
     """
+
+    def __init__(self):
+        self.vehicle = None
+        self.enabled = True
+        self.mav = None
+        self.buf = None
+        self.seq_offset = 0
+        self.payload_offset = 0
+        self.crc_offset = 0
+        self.sent = 0
+
+    def disable(self, reason):
+        self.enabled = False
+        self.vehicle = None
+        log("[SETPOINT] 快速打包已停用, 使用常规 send_mavlink: %s" % reason)
+
+    def bind(self, veh):
+        """以 pack() 的参考帧为模板构造缓冲区 (v1/v2 帧头、目标 ID 均取自参考帧)"""
+        mav = veh._handler.master.mav
+        if getattr(getattr(mav, "signing", None), "sign_outgoing", False):
+            raise ValueError("MAVLink2 签名已启用")
+        if getattr(mav, "send_callback", None) is not None:
+            raise ValueError("存在 send_callback")
+        target = getattr(veh._handler, "target_system", 0)
+        ref_vel = (1.5, -2.25, 0.5)
+        ref_yaw_rate = 0.75
+        msg = veh.message_factory.set_position_target_local_ned_encode(
+            0, target, 0, MAV_FRAME_LOCAL_NED, VELOCITY_TYPE_MASK,
+            0, 0, 0, ref_vel[0], ref_vel[1], ref_vel[2], 0, 0, 0, 0, ref_yaw_rate)
+        ref = bytearray(msg.pack(mav))
+        if ref[0] == 0xFE:
+            header_len, seq_offset = 6, 2
+        elif ref[0] == 0xFD:
+            if ref[2] != 0:
+                raise ValueError("incompat_flags=%d" % ref[2])
+            header_len, seq_offset = 10, 4
+        else:
+            raise ValueError("未知帧头 0x%02X" % ref[0])
+        payload_len = ref[1]
+        payload = struct.pack(SPT_LOCAL_NED_FMT, 0, 0, 0, 0, ref_vel[0], ref_vel[1], ref_vel[2],
+                              0, 0, 0, 0, ref_yaw_rate, VELOCITY_TYPE_MASK,
+                              target, 0, MAV_FRAME_LOCAL_NED)
+        buf = bytearray(ref[:header_len]) + bytearray(payload[:payload_len]) + bytearray(2)
+        self.buf = buf
+        self.mav = mav
+        self.seq_offset = seq_offset
+        self.payload_offset = header_len
+        self.crc_offset = header_len + payload_len
+        self._finish(ref[seq_offset])
+        if buf != ref:
+            raise ValueError("与 pack() 结果不一致")
+        self.vehicle = veh
+        log("[SETPOINT] 快速打包已启用 (MAVLink%s, %d 字节)" % ("1" if ref[0] == 0xFE else "2", len(buf)))
+
+    def _finish(self, seq):
+        buf = self.buf
+        buf[self.seq_offset] = seq
+        crc = x25crc(buf[1:self.crc_offset], SPT_LOCAL_NED_CRC_EXTRA)
+        _MAV_CRC.pack_into(buf, self.crc_offset, crc)
+
+    def send(self, veh, vx, vy, vz, yaw_rate, type_mask, frame):
+        """写入一个速度设定点; 不可用时返回 False (调用方走常规路径)"""
+        if not self.enabled:
+            return False
+        try:
+            if self.vehicle is not veh:
+                self.bind(veh)
+            mav = self.mav
+            buf = self.buf
+            off = self.payload_offset
+            _SPT_VELOCITY.pack_into(buf, off + SPT_VELOCITY_OFFSET, vx, vy, vz)
+            _SPT_YAW_RATE.pack_into(buf, off + SPT_YAW_RATE_OFFSET, yaw_rate)
+            _SPT_TYPE_MASK.pack_into(buf, off + SPT_TYPE_MASK_OFFSET, type_mask)
+            buf[off + SPT_FRAME_OFFSET] = frame
+            seq = mav.seq
+            self._finish(seq)
+            # 发送队列持有引用, 需要拷贝一份
+            mav.file.write(bytes(buf))
+            mav.seq = (seq + 1) % 256
+            mav.total_packets_sent += 1
+            mav.total_bytes_sent += len(buf)
+        except Exception as e:
+            self.disable(str(e))
+            return False
+        self.sent += 1
+        return True
+
+setpoint_packer = SetpointPacker()
+
+def send_ned_velocity(vx, vy, vz, yaw_rate=0.0, frame=MAV_FRAME_LOCAL_NED, type_mask=VELOCITY_TYPE_MASK):
+    """
+    发送 NED 速度 (m/s) 与 yaw_rate (rad/s, 仅 type_mask 启用时生效).
+    frame 为 MAV_FRAME_LOCAL_NED 或 MAV_FRAME_BODY_OFFSET_NED. 仅在 GUIDED 下有效.
+    """
+    vehicle = state.vehicle
     if not vehicle:
         return
+    # 快速路径: 预分配缓冲区直接打包
+    if setpoint_packer.send(vehicle, vx, vy, vz, yaw_rate, type_mask, frame):
+        return
     try:
         # MAVLink set_position_target_local_ned
-        # 参考: MAV_FRAME_LOCAL_NED, type_mask 忽略位置只用速度
+        # 参考: type_mask 忽略位置只用速度 (+ 可选 yaw_rate)
         msg = vehicle.message_factory.set_position_target_local_ned_encode(
             0,       # time_boot_ms
             0, 0,    # target system, target component
-            1,       # MAV_FRAME_LOCAL_NED
-            0b0000111111000111,  # type_mask (只启用速度分量 + yaw_rate 可选)
+            frame,
+            type_mask,
             0, 0, 0,             # x, y, z positions (unused)
             vx, vy, vz,          # x, y, z velocity
             0, 0, 0,             # accelerations (unused)
             0,                   # yaw (unused)
-            0                    # yaw_rate (暂不给)
+            yaw_rate
         )
         vehicle.send_mavlink(msg)
     except Exception as e:
         # 避免刷屏
         pass
 
+def send_setpoint(cmd, forward=False, recv_ts=None):
+    """
+    发送速度设定点并记录; 加锁保证即时转发与 control_loop 不会并发写链路.
+    recv_ts 为该命令对应摇杆帧的收到时间, 用于统计服务器段延迟 (超时清零等为 None).
+    """
+    with setpoint_lock:
+        send_ned_velocity(cmd.vx, cmd.vy, cmd.vz, cmd.yaw_rate, cmd.frame, cmd.type_mask)
+        state.sent = SentSetpoint(cmd, monotonic(), forward)
+        if recv_ts is not None:
+            latency_tracer.setpoint_sent(recv_ts)
+
+def forward_joystick(cmd, mode_name, recv_ts=None):
+    """
+    即时转发: 命令有变化时立即发送, 不等 control_loop 的下一个 tick.
+    距上次发送不足 1/JOY_FORWARD_MAX_HZ 时不发, 由 control_loop 在下一个 tick 补发最新值.
+    """
+    flight = state.flight
+    if JOY_FORWARD_MAX_HZ <= 0 or flight.takeoff_in_progress or flight.landing_in_progress:
+        return False
+    if mode_name not in VELOCITY_MODES or not state.vehicle.armed:
+        return False
+    sent = state.sent
+    if cmd == sent.cmd:
+        return False
+    if monotonic() - sent.ts < 1.0 / JOY_FORWARD_MAX_HZ:
+        return False
+    send_setpoint(cmd, forward=True, recv_ts=recv_ts)
+    return True
+
+def velocity_cmd(vx, vy, vz, yaw_rate, frame=MAV_FRAME_LOCAL_NED, type_mask=VELOCITY_TYPE_MASK):
+    """构造速度设定点; type_mask 屏蔽 yaw_rate 时置 0, 避免无效变化触发即时转发"""
+    if type_mask != VELOCITY_YAW_RATE_TYPE_MASK:
+        yaw_rate = 0.0
+    return VelocityCmd(vx, vy, vz, yaw_rate, frame, type_mask)
+
+def apply_joystick(vx, vy, vz, yaw_rate, frame=MAV_FRAME_LOCAL_NED, type_mask=VELOCITY_TYPE_MASK):
+    """记录最新摇杆命令, 有变化时立即转发 (见 forward_joystick). LOITER 下拒绝, 返回 (ok, msg)"""
+    vehicle = state.vehicle
+    if not vehicle:
+        return False, "飞控未连接 (%s)" % state.link.state
+    # 检查当前模式
+    current_mode = ""
+    try:
+        current_mode = vehicle.mode.name if vehicle else None
+    except:
+        pass
+
+    # 如果在 LOITER 模式，拒绝操作
+    if current_mode == "LOITER":
+        log("[JOYSTICK] 检测到摇杆操作，但当前在 LOITER 模式，拒绝操作")
+        return False, "当前在 LOITER 模式，请切换到 GUIDED 模式以启用摇杆控制"
+
+    cmd = velocity_cmd(vx, vy, vz, yaw_rate, frame, type_mask)
+    # 命令与时间戳一起替换, control_loop 不会读到新命令配旧时间
+    now = time.time()
+    state.joystick = JoystickState(cmd, now)
+    latency_tracer.accepted += 1
+    try:
+        forward_joystick(cmd, current_mode, now)
+    except Exception as e:
+        log("[JOYSTICK] 即时转发失败: %s" % str(e))
+    return True, None
+
+# ========== 控制延迟追踪 ==========
+
+class LatencyHistogram(object):
+    """
+    延迟直方图 (ms): 累计桶计数 (bounds, 末桶为 +Inf) + 最近 LATENCY_RECENT 个样本 (分位数).
+    每个实例只在一个线程 (或同一把锁下) 写入, 读取方拷贝后计算.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.recent = collections.deque(maxlen=LATENCY_RECENT)
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        self.recent.append(ms)
+
+    def summary(self):
+        """最近样本的 p50 / p95 / max (ms); 无样本时为 None"""
+        recent = sorted(self.recent)
+        if not recent:
+            return None
+        n = len(recent)
+        return {
+            "p50_ms": round(recent[n // 2], 1),
+            "p95_ms": round(recent[min(n - 1, int(n * 0.95))], 1),
+            "max_ms": round(recent[-1], 1),
+            "n": n,
+        }
+
+    def buckets(self):
+        """[[上界 ms (None = +Inf), 累计计数], ...]"""
+        out = []
+        total = 0
+        for le, c in zip(self.bounds + (None,), list(self.counts)):
+            total += c
+            out.append([le, total])
+        return out
+
+class ClientClock(object):
+    """
+    单个控制会话的客户端时钟 (ms, uint32 回绕). 两端时钟差未知, 以最近窗口内
+    (收到时间 - 客户端时间) 的最小值为基准, uplink 延迟即超出基准的部分 (排队 / 重传造成的额外延迟).
+    """
+
+    def __init__(self):
+        self.base = None
+        self.cur_min = None
+        self.prev_min = None
+        self.window_start = 0.0
+
+    def uplink_ms(self, client_ts, now):
+        d = (int(now * 1000) - client_ts) & 0xFFFFFFFF
+        if d >= 0x80000000:
+            d -= 0x100000000
+        if self.cur_min is None or now - self.window_start >= LATENCY_CLOCK_WINDOW:
+            self.prev_min, self.cur_min = self.cur_min, d
+            self.window_start = now
+        elif d < self.cur_min:
+            self.cur_min = d
+        base = self.cur_min if self.prev_min is None else min(self.prev_min, self.cur_min)
+        return d - base
+
+class LatencyTracer(object):
+    """
+    摇杆 -> 飞控 分段延迟:
+      uplink    客户端发出 -> 服务器收到 (ClientClock, IOLoop 线程)
+      server    服务器收到 -> 设定点写入链路 (每个摇杆帧只计首次发送, setpoint_lock 下)
+      autopilot 设定点写入 -> 飞控收到, 以 TIMESYNC 往返时间的一半估计 (DroneKit 消息线程)
+    telemetry_loop 每个 tick 调用 sample() 整体替换 summary.
+    """
+
+    HOPS = ("uplink", "server", "autopilot")
+
+    def __init__(self):
+        self.hops = dict((h, LatencyHistogram()) for h in self.HOPS)
+        self.summary = None
+        self.accepted = 0       # 被接受的摇杆帧
+        self.traced = 0         # 其中被发出的 (其余被更新的帧覆盖)
+        self._last_recv = 0.0
+        self._timesync_sent = 0.0
+        self._timesync_ts1 = None
+        self.timesync_enabled = LATENCY_TIMESYNC_INTERVAL > 0
+
+    def uplink(self, clock, client_ts, now):
+        """client_ts 为 0 / None 表示客户端未提供时间戳"""
+        if client_ts:
+            self.hops["uplink"].add(clock.uplink_ms(client_ts, now))
+
+    def setpoint_sent(self, recv_ts):
+        if recv_ts <= self._last_recv:
+            return  # 同一摇杆帧的保活重发
+        self._last_recv = recv_ts
+        self.traced += 1
+        self.hops["server"].add((time.time() - recv_ts) * 1000.0)
+
+    def timesync(self, v):
+        """每 LATENCY_TIMESYNC_INTERVAL 发送一次 TIMESYNC 请求 (link_supervisor 线程); 出错后不再发送"""
+        now = monotonic()
+        if not self.timesync_enabled or now - self._timesync_sent < LATENCY_TIMESYNC_INTERVAL:
+            return
+        self._timesync_sent = now
+        ts1 = int(now * 1e9)
+        try:
+            msg = v.message_factory.timesync_encode(0, ts1)
+            self._timesync_ts1 = ts1
+            with setpoint_lock:
+                v.send_mavlink(msg)
+        except Exception as e:
+            self.timesync_enabled = False
+            log("[LATENCY] TIMESYNC 已停用, 不统计飞控段延迟: %s" % e)
+
+    def _timesync_listener(self, v, name, msg):
+        # tc1 == 0 是飞控发起的请求; 只处理对本进程请求的回复
+        if getattr(msg, 'tc1', 0) == 0 or getattr(msg, 'ts1', None) != self._timesync_ts1:
+            return
+        self._timesync_ts1 = None
+        rtt_ms = (monotonic() * 1e9 - msg.ts1) / 1e6
+        self.hops["autopilot"].add(rtt_ms / 2.0)
+
+    def sample(self):
+        out = {"accepted": self.accepted, "traced": self.traced}
+        for h in self.HOPS:
+            out[h] = self.hops[h].summary()
+        self.summary = out
+        return out
+
+    def histograms(self):
+        out = {}
+        for h in self.HOPS:
+            hist = self.hops[h]
+            out[h] = {"count": hist.count, "sum_ms": round(hist.sum_ms, 1), "buckets": hist.buckets()}
+        return out
+
+latency_tracer = LatencyTracer()
+
+# ========== 定频调度 ==========
+
+class DeadlineScheduler(object):
+    """
+    绝对截止时间调度 (单调时钟): 第 n 个 tick 的目标时刻是 t0 + n*period,
+    与每次循环的工作耗时无关, 实际频率不会低于设定值漂移.
+    落后超过一个周期时跳过错过的 tick (overrun), 不连发追赶.
+    每 CONTROL_STATS_WINDOW 发布一次统计 (stats 整体替换, 其他线程直接读取).
+    """
+
+    def __init__(self, name, hz):
+        self.name = name
+        self.period = 1.0 / hz
+        self.deadline = None
+        self.ticks = 0
+        self.overruns = 0       # 落后超过一个周期的次数
+        self.skipped = 0        # 因此跳过的 tick 数
+        self.stats = {"target_hz": hz}
+        self.lateness = LatencyHistogram(CONTROL_LATE_BUCKETS_MS)   # 每个 tick 相对截止时刻的滞后
+        self._reset_window(monotonic())
+
+    def _reset_window(self, now):
+        self._w_start = now
+        self._w_ticks = 0
+        self._w_sum = 0.0
+        self._w_max = 0.0
+        self._w_overruns = 0
+
+    def reset(self):
+        """长时间停顿 (如异常退避) 后重新对齐, 不计为 overrun"""
+        self.deadline = None
+
+    def wait(self):
+        """睡到下一个截止时刻"""
+        now = monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+            now = monotonic()
+        self._record(now - self.deadline, now)
+        self.deadline += self.period
+        if now >= self.deadline:
+            # 已落后至少一个周期: 丢弃错过的 tick, 从下一个整周期继续
+            missed = int((now - self.deadline) / self.period) + 1
+            self.deadline += missed * self.period
+            self.overruns += 1
+            self.skipped += missed
+            self._w_overruns += 1
+
+    def _record(self, late, now):
+        self.ticks += 1
+        self.lateness.add(late * 1000.0)
+        self._w_ticks += 1
+        self._w_sum += late
+        if late > self._w_max:
+            self._w_max = late
+        span = now - self._w_start
+        if span >= CONTROL_STATS_WINDOW:
+            self.stats = {
+                "target_hz": round(1.0 / self.period, 2),
+                "hz": round(self._w_ticks / span, 2),
+                "jitter_avg_ms": round(self._w_sum / self._w_ticks * 1000, 3),
+                "jitter_max_ms": round(self._w_max * 1000, 3),
+                "overruns": self.overruns,
+                "skipped": self.skipped,
+            }
+            if self._w_overruns:
+                log("[%s] %d 次超时 (最大抖动 %.1f ms)" % (self.name, self._w_overruns, self._w_max * 1000))
+            self._reset_window(now)
+
+control_scheduler = DeadlineScheduler("CONTROL", CONTROL_HZ)
+
 # ========== TAKEOFF ==========
 
 def do_takeoff(target_alt):
-    global takeoff_in_progress, takeoff_target_alt
+    """起飞 (在指令执行器线程中运行). 返回 True 表示已发出 simple_takeoff"""
+    vehicle = state.vehicle
     if not vehicle:
         print("[TAKEOFF] vehicle 不存在")
-        return
+        return False
     if safe_alt() > 0.5:
         print("[TAKEOFF] 认为已在空中 (alt=%.2f)" % safe_alt())
-        return
+        return False
 
     # 进入 GUIDED
-    if not ensure_mode("GUIDED", "GUIDED_NOGPS"):
+    if not ensure_mode("GUIDED"):
 
         print("[TAKEOFF] 无法进入 GUIDED，放弃")
-        return
+        return False
 
     if not arm_vehicle():
         print("[TAKEOFF] 解锁失败，放弃")
-        return
+        return False
 
     print("[TAKEOFF] simple_takeoff(%.2f)" % target_alt)
     try:
         vehicle.simple_takeoff(target_alt)
     except Exception as e:
         print("[TAKEOFF] simple_takeoff 调用异常: %s" % e)
-        return
+        return False
 
-    takeoff_in_progress = True
-    takeoff_target_alt = target_alt
+    state.update_flight(takeoff_in_progress=True, takeoff_target_alt=target_alt)
 
     def watcher():
-        global takeoff_in_progress, takeoff_target_alt
         t0 = time.time()
         
         # 完全模仿 takeoff.py：只监视不干预
@@ -365,191 +1124,1667 @@ def do_takeoff(target_alt):
                 break
             time.sleep(0.5)  # 降低监视频率到0.5秒
             
-        takeoff_in_progress = False
+        state.update_flight(takeoff_in_progress=False)
         print("[TAKEOFF] 监视结束 (当前高度 %.2f)" % safe_alt())
 
     th = threading.Thread(target=watcher)
     th.daemon = True
     th.start()
+    return True
+
+# ========== LAND / BRAKE ==========
+
+def do_land():
+    """切换到 LAND 并设置降落标志 (在指令执行器线程中运行)"""
+    ok = ensure_mode("LAND")
+    if ok:
+        state.update_flight(landing_in_progress=True)
+        log("[LAND] 开始降落过程")
+    return ok
+
+def do_brake_loiter():
+    """非可控模式下的刹车: 切换到 LOITER (在指令执行器线程中运行)"""
+    ok = ensure_mode("LOITER")
+    log("[BRAKE] 切换到 LOITER: %s" % ok)
+    return ok
+
+# ========== 指令执行器 ==========
+
+class CommandExecutor(object):
+    """
+    后台执行耗时的飞控指令 (ensure_mode / arm / disarm / takeoff / land),
+    避免在 IOLoop 线程里 sleep 轮询. 默认单工作线程, 指令按提交顺序串行执行,
+    完成回调 on_done(cmd_id, result, err) 通过 IOLoop.add_callback 回到 IOLoop 线程.
+    """
+
+    def __init__(self, workers=1):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._workers = workers
+        self._started = False
+        self.durations = {}     # 函数名 (ensure_mode / arm_vehicle ...) -> LatencyHistogram
+        self.failures = {}      # 函数名 -> 失败次数
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        for i in range(self._workers):
+            th = threading.Thread(target=self._run)
+            th.daemon = True
+            th.start()
+
+    def submit(self, name, fn, args=(), on_done=None):
+        """提交指令, 立即返回 cmd_id"""
+        with self._lock:
+            self._next_id += 1
+            cmd_id = self._next_id
+        self._queue.put((cmd_id, name, fn, args, on_done))
+        return cmd_id
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            cmd_id, name, fn, args, on_done = self._queue.get()
+            t0 = time.time()
+            result, err = False, None
+            try:
+                result = fn(*args)
+            except Exception as e:
+                err = str(e)
+                log("[CMD] #%d %s 异常: %s" % (cmd_id, name, err))
+            elapsed = time.time() - t0
+            log("[CMD] #%d %s 完成 ok=%s (%.2fs)" % (cmd_id, name, bool(result), elapsed))
+            self._record(getattr(fn, '__name__', name), elapsed, bool(result))
+            if on_done is not None:
+                call_on_ioloop(on_done, cmd_id, result, err)
+
+    def _record(self, fname, elapsed, ok):
+        hist = self.durations.get(fname)
+        if hist is None:
+            hist = self.durations[fname] = LatencyHistogram(COMMAND_BUCKETS_MS)
+        hist.add(elapsed * 1000.0)
+        if not ok:
+            self.failures[fname] = self.failures.get(fname, 0) + 1
+
+command_executor = CommandExecutor(COMMAND_WORKERS)
+
+# ========== 消息编码 (json / msgpack / struct) ==========
+
+# enc=struct 时热点帧使用固定布局 (小端), 其余消息使用 msgpack (未安装时退回 json 文本帧).
+# 首字节为类型标记, 与 msgpack map (0x80~0x8f / 0xde / 0xdf) 不冲突.
+#
+# 遥测包 (tag 0x01):
+#   tag(B) flags(B: bit0 armed, bit1 takeoff_in_progress, bit2-3 链路状态 = TELEM_LINK_STATES 下标)
+#   timestamp_ms(Q)
+#   altitude groundspeed heading roll pitch yaw voltage current (8f, 缺失为 NaN)
+#   battery_level(b, 缺失为 -1) takeoff_target_alt(f)
+#   cmd_age_ms(i, 从未收到摇杆为 -1, 已过期为 CMD_AGE_STALE_MS) mode(12s, ASCII 补 0)
+#   link_quality / latency 不在固定布局中: 变化 (超出死区) 时另发一帧 msgpack {"type":"link",...}
+TELEM_STRUCT_FMT = '<BBQ8fbfi12s'
+TELEM_STRUCT_TAG = 0x01
+TELEM_LINK_STATES = ("connecting", "retry_wait", "connected", "lost")
+# MAVLink ATTITUDE 流 (tag 0x02):
+#   tag(B) time_boot_ms(I) recv_ms(Q) roll pitch yaw rollspeed pitchspeed yawspeed (6f)
+MAV_ATTITUDE_STRUCT_FMT = '<BIQ6f'
+MAV_ATTITUDE_STRUCT_TAG = 0x02
+
+_TELEM_STRUCT = struct.Struct(TELEM_STRUCT_FMT)
+_MAV_ATTITUDE_STRUCT = struct.Struct(MAV_ATTITUDE_STRUCT_FMT)
+_NAN = float('nan')
+
+def _f32(v):
+    return float(v) if v is not None else _NAN
+
+def pack_telemetry(pkt):
+    att = pkt.get("attitude") or {}
+    bat = pkt.get("battery") or {}
+    flags = (1 if pkt.get("armed") else 0) | (2 if pkt.get("takeoff_in_progress") else 0)
+    link_state = (pkt.get("link") or {}).get("state")
+    if link_state in TELEM_LINK_STATES:
+        flags |= TELEM_LINK_STATES.index(link_state) << 2
+    level = bat.get("level")
+    return _TELEM_STRUCT.pack(
+        TELEM_STRUCT_TAG, flags, int(pkt.get("timestamp") or 0),
+        _f32(pkt.get("altitude")), _f32(pkt.get("groundspeed")), _f32(pkt.get("heading")),
+        _f32(att.get("roll")), _f32(att.get("pitch")), _f32(att.get("yaw")),
+        _f32(bat.get("voltage")), _f32(bat.get("current")),
+        int(level) if level is not None else -1,
+        _f32(pkt.get("takeoff_target_alt")), int(pkt.get("cmd_age_ms") or 0),
+        tornado.escape.utf8(pkt.get("mode") or "")[:12])
+
+def pack_mav_attitude(pkt):
+    return _MAV_ATTITUDE_STRUCT.pack(
+        MAV_ATTITUDE_STRUCT_TAG, int(pkt.get("time_boot_ms") or 0), int(pkt.get("recv_ms") or 0),
+        _f32(pkt.get("roll")), _f32(pkt.get("pitch")), _f32(pkt.get("yaw")),
+        _f32(pkt.get("rollspeed")), _f32(pkt.get("pitchspeed")), _f32(pkt.get("yawspeed")))
+
+# 二进制摇杆帧 (客户端 -> /ws/control, 16 字节, 小端):
+#   tag(B='J') flags(B, 保留) seq(H) vx vy vz(h, mm/s) yaw_rate(h, mrad/s) client_ts_ms(I)
+JOY_STRUCT_FMT = '<BBHhhhhI'
+JOY_TAG = 0x4A
+# 二进制摇杆应答 (服务器 -> 客户端, 4 字节): tag(B='K') status(B) seq(H)
+JOY_ACK_STRUCT_FMT = '<BBH'
+JOY_ACK_TAG = 0x4B
+JOY_ACK_OK = 0
+JOY_ACK_REJECTED = 1    # 当前模式不接受摇杆 (LOITER)
+JOY_ACK_BAD_FRAME = 2
+
+_JOY_STRUCT = struct.Struct(JOY_STRUCT_FMT)
+_JOY_ACK_STRUCT = struct.Struct(JOY_ACK_STRUCT_FMT)
+_JOY_TAG_BYTE = struct.pack('<B', JOY_TAG)
+
+# UDP 控制数据报: token(8 字节) + 摇杆帧 (JOY_STRUCT_FMT) 或刹车帧 (BRAKE_STRUCT_FMT)
+# 刹车帧: tag(B='X') flags(B, 保留) seq(H)
+UDP_TOKEN_LEN = 8
+BRAKE_STRUCT_FMT = '<BBH'
+BRAKE_TAG = 0x58
+_BRAKE_STRUCT = struct.Struct(BRAKE_STRUCT_FMT)
+_BRAKE_TAG_BYTE = struct.pack('<B', BRAKE_TAG)
+
+# 帧类型 (Frame.kind) -> struct 打包函数
+STRUCT_PACKERS = {
+    "telemetry": pack_telemetry,
+    "mav:ATTITUDE": pack_mav_attitude,
+}
+
+def msgpack_loads(data):
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except TypeError:
+        # msgpack < 0.5.2 无 raw 参数
+        return msgpack.unpackb(data, encoding='utf-8')
+
+class JsonCodec(object):
+    name = "json"
+
+    def encode(self, obj, kind=None):
+        """返回 (data, binary)"""
+        return tornado.escape.utf8(json.dumps(obj)), False
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    def encode(self, obj, kind=None):
+        # use_bin_type=False: Python 2 的 str 也按字符串类型打包
+        return msgpack.packb(obj, use_bin_type=False), True
+
+class StructCodec(object):
+    name = "struct"
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def encode(self, obj, kind=None):
+        packer = STRUCT_PACKERS.get(kind)
+        if packer is not None:
+            return packer(obj), True
+        return self.fallback.encode(obj, kind)
+
+CODECS = {"json": JsonCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+CODECS["struct"] = StructCodec(CODECS.get("msgpack") or CODECS["json"])
+
+class Frame(object):
+    """
+    待广播的一帧: 按编码惰性序列化并缓存 (仅 IOLoop 线程使用),
+    同一编码的所有客户端共用同一份 bytes.
+    """
+    __slots__ = ('obj', 'kind', '_encoded')
+
+    def __init__(self, obj, kind, json_bytes=None):
+        self.obj = obj
+        self.kind = kind
+        self._encoded = {}
+        if json_bytes is not None:
+            self._encoded["json"] = (json_bytes, False)
+
+    def encoded(self, codec):
+        out = self._encoded.get(codec.name)
+        if out is None:
+            out = codec.encode(self.obj, self.kind)
+            self._encoded[codec.name] = out
+        return out
+
+class CodecMixin(object):
+    """WebSocket 客户端编码协商 (?enc=json|msgpack|struct) 与应答发送"""
+
+    def init_codec(self):
+        want = self.get_argument("enc", "json").lower()
+        self.codec = CODECS.get(want)
+        if self.codec is None:
+            log("编码 %s 不可用, 使用 json" % want)
+            self.codec = CODECS["json"]
+        if want != "json":
+            hello = {"type":"hello","enc":self.codec.name}
+            if self.codec.name == "struct":
+                hello["layouts"] = {"telemetry": TELEM_STRUCT_FMT, "mav:ATTITUDE": MAV_ATTITUDE_STRUCT_FMT}
+                hello["link_states"] = TELEM_LINK_STATES
+            self.reply(hello)
+
+    def reply(self, obj):
+        """发送应答 (不参与背压丢帧); 客户端已断开时静默丢弃 (异步指令完成时可能已断开)"""
+        data, binary = self.codec.encode(obj)
+        try:
+            self.write_message(data, binary=binary)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def decode(self, message):
+        """文本帧按 JSON, 二进制帧按 msgpack 解析"""
+        if isinstance(message, bytes):
+            if msgpack is None:
+                raise ValueError("msgpack 未安装, 不支持二进制消息")
+            return msgpack_loads(message)
+        return json.loads(message)
 
 # ========== WebSocket / HTTP 处理 ==========
 
-class ControlWS(tornado.websocket.WebSocketHandler):
+class ControlWS(CodecMixin, tornado.websocket.WebSocketHandler):
     def open(self):
+        self.init_codec()
+        self.ack_mode = self.get_argument("ack", JOY_ACK_MODE)
+        if self.ack_mode not in ("each", "cumulative"):
+            self.ack_mode = JOY_ACK_MODE
+        self._ack_timer = None
+        try:
+            yaw_rate = parse_bool(self.get_argument("yaw_rate", "1" if SETPOINT_YAW_RATE else "0"))
+        except ValueError:
+            # 与 {"type":"setpoint"} 同样严格; close reason 长度有限, 不带原值
+            self.close(1008, "yaw_rate 必须是 true/false/1/0")
+            return
+        self.set_setpoint_mode(self.get_argument("frame", SETPOINT_FRAME), yaw_rate)
+        self.joy_seq = None         # 最近一次被接受的摇杆 seq
+        self.joy_count = 0
+        self.client_clock = ClientClock()
+        self._joy_binary = False    # 最近一次摇杆是否为二进制帧 (决定累计 ack 的格式)
+        self._acked_seq = None
+        if self.ack_mode == "cumulative":
+            self._ack_timer = tornado.ioloop.PeriodicCallback(self._send_cumulative_ack, JOY_ACK_INTERVAL * 1000)
+            self._ack_timer.start()
         control_clients.add(self)
-        log("Control client connected (%d)" % len(control_clients))
+        log("Control client connected (%d, ack=%s, frame=%s, yaw_rate=%s)" % (
+            len(control_clients), self.ack_mode, self.sp_frame_name, self.sp_yaw_rate))
+
+    def set_setpoint_mode(self, frame_name, yaw_rate):
+        """本会话摇杆速度的坐标系与 yaw_rate 开关; 未知坐标系退回 SETPOINT_FRAME"""
+        if frame_name not in SETPOINT_FRAMES:
+            frame_name = SETPOINT_FRAME
+        self.sp_frame_name = frame_name
+        self.sp_frame = SETPOINT_FRAMES[frame_name]
+        self.sp_yaw_rate = bool(yaw_rate)
+        self.sp_type_mask = VELOCITY_YAW_RATE_TYPE_MASK if self.sp_yaw_rate else VELOCITY_TYPE_MASK
+
+    def _joystick_accepted(self, seq, binary):
+        self.joy_count += 1
+        self.joy_seq = seq if seq is not None else self.joy_count
+        self._joy_binary = binary
+
+    def _send_cumulative_ack(self):
+        """确认自上次以来收到的最新摇杆 seq (无新摇杆时不发送)"""
+        seq = self.joy_seq
+        if seq is None or seq == self._acked_seq:
+            return
+        self._acked_seq = seq
+        if self._joy_binary:
+            try:
+                self.write_message(_JOY_ACK_STRUCT.pack(JOY_ACK_TAG, JOY_ACK_OK, seq & 0xFFFF), binary=True)
+            except tornado.websocket.WebSocketClosedError:
+                pass
+        else:
+            self.reply({"type":"ack","cmd":"joystick","ok":True,"seq":seq,"count":self.joy_count})
+
+    def submit_command(self, cmd, fn, args=(), extra=None):
+        """
+        把耗时指令交给 command_executor:
+        立即回复 {"type":"accepted"}, 完成后推送带同一 cmd_id 的 ack.
+        """
+        extra = extra or {}
+
+        def on_done(cmd_id, result, err):
+            reply = {"type":"ack","cmd":cmd,"cmd_id":cmd_id,"ok":bool(result)}
+            reply.update(extra)
+            if err:
+                reply["msg"] = err
+            self.reply(reply)
+
+        cmd_id = command_executor.submit(cmd, fn, args, on_done)
+        accepted = {"type":"accepted","cmd":cmd,"cmd_id":cmd_id,"queued":command_executor.pending()}
+        accepted.update(extra)
+        self.reply(accepted)
+
+    def on_joystick_frame(self, message):
+        """二进制摇杆帧快速路径: 不做 JSON 解析/编码, 应答也是 4 字节二进制"""
+        try:
+            tag, flags, seq, vx, vy, vz, yaw_rate, client_ts = _JOY_STRUCT.unpack(message)
+        except struct.error:
+            self.write_message(_JOY_ACK_STRUCT.pack(JOY_ACK_TAG, JOY_ACK_BAD_FRAME, 0), binary=True)
+            return
+        latency_tracer.uplink(self.client_clock, client_ts, time.time())
+        ok, msg = apply_joystick(vx * 0.001, vy * 0.001, vz * 0.001, yaw_rate * 0.001,
+                                 self.sp_frame, self.sp_type_mask)
+        if ok:
+            self._joystick_accepted(seq, True)
+            if self.ack_mode == "cumulative":
+                return
+        status = JOY_ACK_OK if ok else JOY_ACK_REJECTED
+        self.write_message(_JOY_ACK_STRUCT.pack(JOY_ACK_TAG, status, seq), binary=True)
 
     def on_message(self, message):
-        global last_velocity_cmd, last_joystick_time
+        if isinstance(message, bytes) and message[:1] == _JOY_TAG_BYTE:
+            self.on_joystick_frame(message)
+            return
         try:
-            data = json.loads(message)
+            data = self.decode(message)
         except Exception as e:
-            self.write_message(json.dumps({"type":"error","msg":"invalid json","detail":str(e)}))
+            self.reply({"type":"error","msg":"invalid message","detail":str(e)})
             return
 
         typ = data.get("type")
 
-        # 摇杆速度
+        # 摇杆速度 (JSON 版本, 二进制帧见 on_joystick_frame)
         if typ == "joystick":
-            # 检查当前模式
-            current_mode = ""
+            # 先校验再生效: 非法输入回 NACK, 不执行命令也不抛异常 (否则 Tornado 会断开控制连接)
+            seq = data.get("seq")
             try:
-                current_mode = vehicle.mode.name if vehicle else None
-            except:
+                vx, vy, vz, yaw_rate = [finite_float(data.get(k, 0.0)) for k in ("vx", "vy", "vz", "yaw_rate")]
+                if seq is not None:
+                    seq = int(finite_float(seq))
+            except (TypeError, ValueError) as e:
+                self.reply({"type":"ack","cmd":"joystick","ok":False,"seq":seq,"msg":"参数无效: %s" % e})
+                return
+            try:
+                latency_tracer.uplink(self.client_clock, int(finite_float(data.get("ts") or 0)) & 0xFFFFFFFF,
+                                      time.time())
+            except (TypeError, ValueError):
                 pass
-            
-            # 如果在 LOITER 模式，拒绝操作
-            if current_mode == "LOITER":
-                log("[JOYSTICK] 检测到摇杆操作，但当前在 LOITER 模式，拒绝操作")
-                self.write_message(json.dumps({
-                    "type":"ack",
-                    "cmd":"joystick",
-                    "ok":False,
-                    "msg":"当前在 LOITER 模式，请切换到 GUIDED 模式以启用摇杆控制"
-                }))
+            ok, msg = apply_joystick(vx, vy, vz, yaw_rate, self.sp_frame, self.sp_type_mask)
+            if not ok:
+                self.reply({"type":"ack","cmd":"joystick","ok":False,"seq":seq,"msg":msg})
                 return
-            
-            # 正常处理摇杆数据（在可控模式下）
-            vx = float(data.get("vx", 0.0))
-            vy = float(data.get("vy", 0.0))
-            vz = float(data.get("vz", 0.0))
-            yaw_rate = float(data.get("yaw_rate", 0.0))
-            last_velocity_cmd = {"vx": vx, "vy": vy, "vz": vz, "yaw_rate": yaw_rate}
-            last_joystick_time = time.time()
-            self.write_message(json.dumps({"type":"ack","cmd":"joystick","ok":True}))
+            self._joystick_accepted(seq, False)
+            if self.ack_mode == "each":
+                self.reply({"type":"ack","cmd":"joystick","ok":True})
+            return
+
+        # 摇杆坐标系 / yaw_rate: {"type":"setpoint","frame":"body","yaw_rate":true}
+        if typ == "setpoint":
+            frame_name = data.get("frame", self.sp_frame_name)
+            if frame_name not in SETPOINT_FRAMES:
+                self.reply({"type":"ack","cmd":"setpoint","ok":False,"msg":"frame 必须是 local 或 body"})
+                return
+            try:
+                yaw_rate = parse_bool(data.get("yaw_rate", self.sp_yaw_rate))
+            except ValueError as e:
+                self.reply({"type":"ack","cmd":"setpoint","ok":False,"msg":str(e)})
+                return
+            self.set_setpoint_mode(frame_name, yaw_rate)
+            log("[SETPOINT] frame=%s yaw_rate=%s" % (self.sp_frame_name, self.sp_yaw_rate))
+            self.reply({"type":"ack","cmd":"setpoint","ok":True,
+                        "frame":self.sp_frame_name,"yaw_rate":self.sp_yaw_rate})
+            return
+
+        # 飞控链路未就绪时直接拒绝, 不进入指令执行器排队
+        if typ in VEHICLE_COMMANDS and not state.vehicle:
+            self.reply({"type":"ack","cmd":typ,"ok":False,"msg":"飞控未连接","link":state.link.state})
             return
 
         # 切模式
         if typ == "mode":
             m = str(data.get("mode","")).upper()
             if not m:
-                self.write_message(json.dumps({"type":"ack","cmd":"mode","ok":False,"msg":"空模式"}))
+                self.reply({"type":"ack","cmd":"mode","ok":False,"msg":"空模式"})
                 return
-            ok = ensure_mode(m)
-            self.write_message(json.dumps({"type":"ack","cmd":"mode","requested":m,"ok":ok}))
+            self.submit_command("mode", ensure_mode, (m,), {"requested": m})
             return
 
         # ARM
         if typ == "arm":
-            ok = arm_vehicle()
-            self.write_message(json.dumps({"type":"ack","cmd":"arm","ok":ok}))
+            self.submit_command("arm", arm_vehicle)
             return
 
         # DISARM
         if typ == "disarm":
-            ok = disarm_vehicle()
-            self.write_message(json.dumps({"type":"ack","cmd":"disarm","ok":ok}))
+            self.submit_command("disarm", disarm_vehicle)
             return
 
         # TAKEOFF
         if typ == "takeoff":
             alt = float(data.get("alt", DEFAULT_TAKEOFF_ALT))
-            t = threading.Thread(target=do_takeoff, args=(alt,))
-            t.daemon = True
-            t.start()
-            self.write_message(json.dumps({"type":"ack","cmd":"takeoff","alt":alt,"ok":True}))
+            self.submit_command("takeoff", do_takeoff, (alt,), {"alt": alt})
             return
 
         # LAND
         if typ == "land":
-            global landing_in_progress
-            ok = ensure_mode("LAND")
-            if ok:
-                landing_in_progress = True
-                log("[LAND] 开始降落过程")
-            self.write_message(json.dumps({"type":"ack","cmd":"land","ok":ok}))
+            self.submit_command("land", do_land)
             return
 
         # BRAKE: 立即停止水平移动
         if typ == "brake":
-            if not vehicle:
-                self.write_message(json.dumps({"type":"ack","cmd":"brake","ok":False,"msg":"vehicle not connected"}))
-                return
-            
-            if not vehicle.armed:
-                self.write_message(json.dumps({"type":"ack","cmd":"brake","ok":False,"msg":"not armed"}))
+            self.handle_brake()
+            return
+
+        # UDP 控制通道会话: 返回端口与 token
+        if typ == "udp_session":
+            if udp_control is None:
+                self.reply({"type":"udp_session","ok":False,"msg":"UDP 控制通道未启用 (DRONE_UDP_PORT)"})
                 return
-            
-            try:
-                mode_name = vehicle.mode.name
-                if mode_name in ("GUIDED", "GUIDED_NOGPS", "POSHOLD"):
-                    # 在可控模式下,发送速度归零
-                    send_ned_velocity(0.0, 0.0, 0.0, 0.0)
-                    # 清空摇杆命令
-                    last_velocity_cmd = {"vx": 0.0, "vy": 0.0, "vz": 0.0, "yaw_rate": 0.0}
-                    last_joystick_time = 0.0
-                    log("[BRAKE] 速度已归零，保持在 %s 模式" % mode_name)
-                    self.write_message(json.dumps({"type":"ack","cmd":"brake","ok":True}))
-                elif mode_name == "LOITER":
-                    # 在 LOITER 模式下，提醒用户
-                    log("[BRAKE] 当前在 LOITER 模式，已自动悬停")
-                    self.write_message(json.dumps({
-                        "type":"ack",
-                        "cmd":"brake",
-                        "ok":True,
-                        "msg":"当前在 LOITER 模式，已自动悬停。如需摇杆控制，请切换到 GUIDED 模式"
-                    }))
-                else:
-                    # 其他模式,尝试切换到 LOITER
-                    ok = ensure_mode("LOITER")
-                    log("[BRAKE] 切换到 LOITER: %s" % ok)
-                    self.write_message(json.dumps({"type":"ack","cmd":"brake","ok":ok,"msg":"switched to LOITER"}))
-            except Exception as e:
-                log("[BRAKE] 异常: %s" % str(e))
-                self.write_message(json.dumps({"type":"ack","cmd":"brake","ok":False,"msg":str(e)}))
+            token = udp_control.open_session(self)
+            self.reply({"type":"udp_session","ok":True,"port":udp_control.port,
+                        "token":binascii.hexlify(token).decode("ascii")})
             return
 
         # 诊断(可选)
         if typ == "diag":
-            st = get_basic_status()
+            st = dict(current_snapshot().status)
             # 附加最近几条 statustext
             statetxt = list(recent_statustext)[-5:]
             st['recent_statustext'] = statetxt
-            self.write_message(json.dumps({"type":"diag_reply","diag":st}))
+            self.reply({"type":"diag_reply","diag":st})
             return
 
-        self.write_message(json.dumps({"type":"ack","cmd":typ,"ok":False,"msg":"unknown type"}))
+        self.reply({"type":"ack","cmd":typ,"ok":False,"msg":"unknown type"})
+
+    def handle_brake(self):
+        """刹车 (WebSocket 与 UDP 通道共用), 应答走 WebSocket"""
+        vehicle = state.vehicle
+        if not vehicle:
+            self.reply({"type":"ack","cmd":"brake","ok":False,"msg":"vehicle not connected"})
+            return
+        
+        if not vehicle.armed:
+            self.reply({"type":"ack","cmd":"brake","ok":False,"msg":"not armed"})
+            return
+        
+        try:
+            mode_name = vehicle.mode.name
+            if mode_name in ("GUIDED", "GUIDED_NOGPS", "POSHOLD"):
+                # 在可控模式下,发送速度归零
+                zero = velocity_cmd(0.0, 0.0, 0.0, 0.0, self.sp_frame, self.sp_type_mask)
+                send_setpoint(zero)
+                # 清空摇杆命令
+                state.joystick = JoystickState(zero, 0.0)
+                log("[BRAKE] 速度已归零，保持在 %s 模式" % mode_name)
+                self.reply({"type":"ack","cmd":"brake","ok":True})
+            elif mode_name == "LOITER":
+                # 在 LOITER 模式下，提醒用户
+                log("[BRAKE] 当前在 LOITER 模式，已自动悬停")
+                self.reply({
+                    "type":"ack",
+                    "cmd":"brake",
+                    "ok":True,
+                    "msg":"当前在 LOITER 模式，已自动悬停。如需摇杆控制，请切换到 GUIDED 模式"
+                })
+            else:
+                # 其他模式,尝试切换到 LOITER (后台执行)
+                self.submit_command("brake", do_brake_loiter, (), {"msg": "switched to LOITER"})
+        except Exception as e:
+            log("[BRAKE] 异常: %s" % str(e))
+            self.reply({"type":"ack","cmd":"brake","ok":False,"msg":str(e)})
 
     def on_close(self):
         if self in control_clients:
             control_clients.remove(self)
+        if udp_control is not None:
+            udp_control.close_session(self)
+        if self._ack_timer is not None:
+            self._ack_timer.stop()
         log("Control client disconnected (%d)" % len(control_clients))
 
     def check_origin(self, origin):
         return True
 
 
-class TelemetryWS(tornado.websocket.WebSocketHandler):
+# ========== UDP 控制通道 (joystick / brake) ==========
+
+class UdpSession(object):
+    """一个 /ws/control 连接对应的 UDP 会话; 连接关闭时 token 失效"""
+
+    def __init__(self, ws, token):
+        self.ws = ws
+        self.token = token
+        self.addr = None
+        self.last_seq = None
+        self.received = 0
+        self.stale = 0
+
+    def accept_seq(self, seq):
+        """uint16 回绕比较: 只接受比上一帧新的 seq, 重复/乱序/重放的旧帧丢弃"""
+        if self.last_seq is not None:
+            diff = (seq - self.last_seq) & 0xFFFF
+            if diff == 0 or diff >= 0x8000:
+                self.stale += 1
+                return False
+        self.last_seq = seq
+        return True
+
+class UdpControlServer(object):
+    """
+    低延迟控制通道: 非阻塞 UDP socket 挂在 IOLoop 上 (add_handler), 没有 TCP 队头阻塞,
+    丢一个包不会拖住后续摇杆帧. 数据报 = token + 摇杆帧/刹车帧;
+    token 由 /ws/control 的 udp_session 分配, 可靠指令 (mode/arm/takeoff) 仍走 WebSocket.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("0.0.0.0", port))
+        self.sock.setblocking(0)
+        self.sessions = {}      # token -> UdpSession
+        self.rejected = 0       # token 无效 / 帧格式错误
+
+    def stats(self):
+        sessions = list(self.sessions.values())
+        return {
+            "sessions": len(sessions),
+            "received": sum(sess.received for sess in sessions),
+            "stale": sum(sess.stale for sess in sessions),
+            "rejected": self.rejected,
+        }
+
+    def start(self, io_loop):
+        io_loop.add_handler(self.sock.fileno(), self._on_readable, tornado.ioloop.IOLoop.READ)
+        log("UDP control channel on 0.0.0.0:%d" % self.port)
+
+    def open_session(self, ws):
+        self.close_session(ws)
+        token = os.urandom(UDP_TOKEN_LEN)
+        self.sessions[token] = UdpSession(ws, token)
+        return token
+
+    def close_session(self, ws):
+        for token, sess in list(self.sessions.items()):
+            if sess.ws is ws:
+                del self.sessions[token]
+                log("UDP session closed (received %d, stale %d)" % (sess.received, sess.stale))
+
+    def _on_readable(self, fd, events):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(256)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log("UDP recv 异常: %s" % e)
+                return
+            self._on_datagram(data, addr)
+
+    def _on_datagram(self, data, addr):
+        sess = self.sessions.get(data[:UDP_TOKEN_LEN])
+        if sess is None:
+            self.rejected += 1
+            return
+        frame = data[UDP_TOKEN_LEN:]
+        tag = frame[:1]
+        try:
+            if tag == _JOY_TAG_BYTE:
+                tag_, flags, seq, vx, vy, vz, yaw_rate, client_ts = _JOY_STRUCT.unpack(frame)
+            elif tag == _BRAKE_TAG_BYTE:
+                tag_, flags, seq = _BRAKE_STRUCT.unpack(frame)
+            else:
+                self.rejected += 1
+                return
+        except struct.error:
+            self.rejected += 1
+            return
+        if not sess.accept_seq(seq):
+            return
+        sess.received += 1
+        sess.addr = addr
+
+        if tag == _BRAKE_TAG_BYTE:
+            sess.ws.handle_brake()
+            return
+        latency_tracer.uplink(sess.ws.client_clock, client_ts, time.time())
+        ok, msg = apply_joystick(vx * 0.001, vy * 0.001, vz * 0.001, yaw_rate * 0.001,
+                                 sess.ws.sp_frame, sess.ws.sp_type_mask)
+        if ok:
+            # ack=cumulative 时由 WebSocket 周期性确认; ack=each 时下面直接经 UDP 逐条应答
+            sess.ws._joystick_accepted(seq, True)
+            if sess.ws.ack_mode == "cumulative":
+                return
+        status = JOY_ACK_OK if ok else JOY_ACK_REJECTED
+        try:
+            self.sock.sendto(_JOY_ACK_STRUCT.pack(JOY_ACK_TAG, status, seq), addr)
+        except socket.error:
+            pass
+
+udp_control = None
+
+# 背压丢弃了增量帧后的占位: 真正发送时换成基于当前基线的关键帧
+_KEYFRAME = object()
+
+class TelemetryWS(CodecMixin, tornado.websocket.WebSocketHandler):
     def open(self):
+        self.init_codec()
+        self._inflight = 0      # 已交给 IOStream 但尚未写到 socket 的帧数
+        self._pending = collections.OrderedDict()  # 背压期间每类帧只保留最新一帧
+        self.dropped = 0
+        self.subs = []          # 字段订阅 [(PeriodicCallback, fields)], 非空时不再接收默认遥测包
+        self.streams = set()    # 逐条转发的 MAVLink 消息名
+        self.delta = self.get_argument("delta", "0") not in ("0", "false", "")
         telemetry_clients.add(self)
-        log("Telemetry client connected (%d)" % len(telemetry_clients))
+        log("Telemetry client connected (%d)%s" % (len(telemetry_clients), " [delta]" if self.delta else ""))
+        if self.delta and telemetry_delta.ready():
+            self.send_frame(_KEYFRAME)
+        elif self.codec.name == "struct" and link_frames.frame is not None:
+            self.send_frame(link_frames.frame, "link")
+
+    def send_frame(self, frame, key="telemetry"):
+        """
+        仅在 IOLoop 线程调用. 慢客户端 (未写完帧数达到 TELEM_MAX_INFLIGHT) 每类帧 (key)
+        只保留最新一帧, 写缓冲不会无限增长, 也不会拖慢其他客户端.
+        """
+        if self._inflight >= TELEM_MAX_INFLIGHT:
+            if key in self._pending:
+                self.dropped += 1
+                if self.delta and key == "telemetry":
+                    # 增量帧被丢弃后基线不再连续, 改为补发关键帧
+                    frame = _KEYFRAME
+            self._pending[key] = frame
+            return
+        self._write_frame(frame)
+
+    def _write_frame(self, frame):
+        if frame is _KEYFRAME:
+            frame = telemetry_delta.keyframe()
+        data, binary = frame.encoded(self.codec)
+        try:
+            fut = self.write_message(data, binary=binary)
+        except tornado.websocket.WebSocketClosedError:
+            telemetry_clients.discard(self)
+            return
+        if fut is None:
+            # 旧版 tornado 不返回 Future, 无法感知写缓冲
+            return
+        self._inflight += 1
+        fut.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, fut):
+        self._inflight -= 1
+        try:
+            fut.exception()
+        except:
+            pass
+        while self._pending and self._inflight < TELEM_MAX_INFLIGHT:
+            key, frame = self._pending.popitem(last=False)
+            self._write_frame(frame)
+
+    def on_message(self, message):
+        try:
+            data = self.decode(message)
+        except Exception as e:
+            self.reply({"type":"error","msg":"invalid message","detail":str(e)})
+            return
+
+        typ = data.get("type")
+
+        # 字段订阅: {"type":"subscribe","fields":{"attitude":50,"battery":1}}
+        if typ == "subscribe":
+            fields = data.get("fields")
+            if not isinstance(fields, dict) or not fields:
+                self.reply({"type":"error","msg":"fields 必须是 {字段: Hz}"})
+                return
+            unknown = [f for f in fields if f not in TELEM_FIELD_READERS]
+            if unknown:
+                self.reply({"type":"error","msg":"unknown fields","fields":unknown})
+                return
+            try:
+                # NaN 会穿过 min/max 钳位, 之后 PeriodicCallback 抛异常断开连接, 必须先拒绝
+                rates = dict((f, min(max(finite_float(hz), TELEM_SUB_MIN_HZ), TELEM_SUB_MAX_HZ))
+                             for f, hz in fields.items())
+            except (TypeError, ValueError):
+                self.reply({"type":"error","msg":"频率必须是有限数字"})
+                return
+            self._subscribe(rates)
+            self.reply({"type":"subscribed","fields":rates})
+            return
+
+        # MAVLink 高频消息流: {"type":"stream","messages":["ATTITUDE","GLOBAL_POSITION_INT"]}
+        if typ == "stream":
+            names = data.get("messages") or []
+            if not isinstance(names, list):
+                self.reply({"type":"error","msg":"messages 必须是列表"})
+                return
+            names = set(str(n).upper() for n in names)
+            unknown = sorted(names - set(MAV_STREAM_MESSAGES))
+            if unknown:
+                self.reply({"type":"error","msg":"unknown messages","messages":unknown})
+                return
+            self.streams = names
+            if names:
+                stream_clients.add(self)
+            else:
+                stream_clients.discard(self)
+            self.reply({"type":"streaming","messages":sorted(names)})
+            return
+
+        # 取消订阅, 恢复默认遥测包
+        if typ == "unsubscribe":
+            self._unsubscribe()
+            self.reply({"type":"subscribed","fields":{}})
+            return
+
+        self.reply({"type":"error","msg":"unknown type","cmd":typ})
+
+    def _subscribe(self, rates):
+        """同一频率的字段合并为一帧, 每个频率一个独立的 PeriodicCallback"""
+        self._unsubscribe()
+        groups = {}
+        for f, hz in rates.items():
+            groups.setdefault(hz, []).append(f)
+        for hz, fields in groups.items():
+            fields = tuple(sorted(fields))
+            key = "sub:" + ",".join(fields)
+            pc = tornado.ioloop.PeriodicCallback(
+                lambda fields=fields, key=key: self.send_frame(field_cache.frame(fields), key),
+                1000.0 / hz)
+            pc.start()
+            self.subs.append((pc, fields))
+        log("Telemetry client subscribed: %s" % rates)
+
+    def _unsubscribe(self):
+        for pc, fields in self.subs:
+            pc.stop()
+        self.subs = []
 
     def on_close(self):
         if self in telemetry_clients:
             telemetry_clients.remove(self)
-        log("Telemetry client disconnected (%d)" % len(telemetry_clients))
+        stream_clients.discard(self)
+        self._unsubscribe()
+        self._pending.clear()
+        log("Telemetry client disconnected (%d, dropped %d frames)" % (len(telemetry_clients), self.dropped))
 
     def check_origin(self, origin):
         return True
 
 
 class StatusHandler(tornado.web.RequestHandler):
+    _waiter = None
+    _version = None     # 未写出状态 (长轮询中客户端断开) 时为 None, 不生成 ETag
+    _gzip = False
+
+    @tornado.gen.coroutine
     def get(self):
-        st = get_basic_status()
-        st['ok'] = True
+        snap = current_snapshot()
+        wait = self.get_argument("wait", None)
+        if wait is not None:
+            try:
+                wait = int(wait)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "wait 必须是状态版本号")
+            if snap.version == wait:
+                # 长轮询: 挂起到出现新版本; 超时则返回当前 (未变化的) 状态
+                self._waiter = status_watchers.wait()
+                try:
+                    snap = yield tornado.gen.with_timeout(
+                        datetime.timedelta(seconds=STATUS_LONGPOLL_TIMEOUT), self._waiter)
+                except tornado.gen.TimeoutError:
+                    status_watchers.discard(self._waiter)
+                    snap = current_snapshot()
+                self._waiter = None
+                if snap is None:
+                    return  # 客户端已断开
+        self.write_status(snap)
+
+    def on_connection_close(self):
+        if self._waiter is not None:
+            status_watchers.discard(self._waiter)
+            if not self._waiter.done():
+                self._waiter.set_result(None)
+
+    def write_status(self, snap):
+        self._version = snap.version
+        self._gzip = False
         self.set_header("Content-Type","application/json")
-        self.write(json.dumps(st))
+        self.set_header("Cache-Control","no-cache")
+        body = snap.status_json
+        if STATUS_GZIP_MIN:
+            self.set_header("Vary","Accept-Encoding")
+            if len(body) >= STATUS_GZIP_MIN and "gzip" in self.request.headers.get("Accept-Encoding", ""):
+                self.set_header("Content-Encoding","gzip")
+                self._gzip = True
+                body = status_gzip(snap)
+        self.write(body)
+
+    def compute_etag(self):
+        """ETag 取状态版本号, 不对响应体做哈希; If-None-Match 命中时 Tornado 直接回 304"""
+        if self._version is None:
+            return None
+        return '"%d%s"' % (self._version, "-gz" if self._gzip else "")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """控制循环 / 链路质量 / 控制延迟等统计 (JSON); link_quality 为遥测同名字段加上累计计数与各组件明细, latency 含完整直方图"""
+
+    def get(self):
+        self.set_header("Content-Type","application/json")
+        self.set_header("Cache-Control","no-cache")
+        self.write(json.dumps({
+            "ok": True,
+            "link": dict(state.link._asdict()),
+            "control_loop": control_scheduler.stats,
+            "link_quality": link_quality.detail,
+            "latency": latency_tracer.summary,
+            "latency_histograms": latency_tracer.histograms(),
+            "udp": udp_control.stats() if udp_control is not None else None,
+        }))
+
+# ========== Prometheus /metrics ==========
+
+class IOLoopLagMonitor(object):
+    """每 IOLOOP_LAG_INTERVAL 预约一次回调, 实际执行时刻与预约时刻之差即 IOLoop 延迟 (仅 IOLoop 线程)"""
+
+    def __init__(self):
+        self.lag = LatencyHistogram(IOLOOP_BUCKETS_MS)
+        self._loop = None
+        self._due = 0.0
+
+    def start(self, loop):
+        self._loop = loop
+        self._schedule()
+
+    def _schedule(self):
+        self._due = monotonic() + IOLOOP_LAG_INTERVAL
+        self._loop.call_later(IOLOOP_LAG_INTERVAL, self._tick)
+
+    def _tick(self):
+        self.lag.add(max(0.0, monotonic() - self._due) * 1000.0)
+        self._schedule()
+
+ioloop_lag = IOLoopLagMonitor()
+
+class PromWriter(object):
+    """Prometheus 文本格式 (0.0.4) 拼装"""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, typ, help_text, samples):
+        """samples: [(labels dict 或 None, value), ...]; value 为 None 的样本不输出"""
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s %s" % (name, typ))
+        for labels, value in samples:
+            if value is not None:
+                self.lines.append("%s%s %s" % (name, _prom_labels(labels), _prom_value(value)))
+
+    def histogram(self, name, help_text, hists):
+        """hists: [(labels dict 或 None, LatencyHistogram), ...]; 以秒输出"""
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s histogram" % name)
+        for labels, hist in hists:
+            labels = labels or {}
+            for le, total in hist.buckets():
+                bl = dict(labels)
+                bl["le"] = "+Inf" if le is None else _prom_value(le / 1000.0)
+                self.lines.append("%s_bucket%s %d" % (name, _prom_labels(bl), total))
+            self.lines.append("%s_sum%s %s" % (name, _prom_labels(labels), _prom_value(hist.sum_ms / 1000.0)))
+            self.lines.append("%s_count%s %d" % (name, _prom_labels(labels), hist.count))
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                              for k, v in sorted(labels.items()))
+
+def _prom_value(v):
+    if isinstance(v, bool):
+        return "1" if v else "0"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def render_metrics():
+    """汇总各模块已有的计数 / 直方图 (只读引用, 不加锁, 不打扰控制循环)"""
+    w = PromWriter()
+    sched = control_scheduler
+    stats = sched.stats
+    w.metric("drone_control_loop_target_hz", "gauge", "Configured control loop rate",
+             [(None, stats.get("target_hz"))])
+    w.metric("drone_control_loop_hz", "gauge", "Measured control loop rate over the last stats window",
+             [(None, stats.get("hz"))])
+    w.metric("drone_control_loop_jitter_max_seconds", "gauge", "Max tick lateness over the last stats window",
+             [(None, stats["jitter_max_ms"] / 1000.0 if "jitter_max_ms" in stats else None)])
+    w.metric("drone_control_loop_ticks_total", "counter", "Control loop ticks", [(None, sched.ticks)])
+    w.metric("drone_control_loop_overruns_total", "counter", "Control loop overruns", [(None, sched.overruns)])
+    w.metric("drone_control_loop_skipped_ticks_total", "counter", "Ticks skipped after overruns",
+             [(None, sched.skipped)])
+    w.histogram("drone_control_loop_lateness_seconds", "Control tick lateness behind its deadline",
+                [(None, sched.lateness)])
+    w.metric("drone_setpoints_fast_path_total", "counter", "Setpoints written by the preallocated packer",
+             [(None, setpoint_packer.sent)])
+
+    w.histogram("drone_telemetry_fanout_seconds", "Time to fan one telemetry snapshot out to all clients",
+                [(None, telemetry_fanout)])
+    w.histogram("drone_ioloop_lag_seconds", "IOLoop callback scheduling delay", [(None, ioloop_lag.lag)])
+
+    udp_sessions = len(udp_control.sessions) if udp_control is not None else 0
+    w.metric("drone_clients", "gauge", "Connected clients", [
+        ({"kind": "control"}, len(control_clients)),
+        ({"kind": "telemetry"}, len(telemetry_clients)),
+        ({"kind": "stream"}, len(stream_clients)),
+        ({"kind": "status_watchers"}, len(status_watchers._futures) + len(status_watchers.streams)),
+        ({"kind": "udp"}, udp_sessions),
+    ])
+    w.metric("drone_udp_datagrams_rejected_total", "counter", "UDP datagrams with an unknown token or bad frame",
+             [(None, udp_control.rejected if udp_control is not None else 0)])
+
+    durations = list(command_executor.durations.items())
+    failures = dict(command_executor.failures)
+    w.histogram("drone_command_duration_seconds", "Vehicle command execution time",
+                [({"command": k}, h) for k, h in sorted(durations)])
+    w.metric("drone_command_failures_total", "counter", "Vehicle commands that failed",
+             [({"command": k}, failures.get(k, 0)) for k, h in sorted(durations)])
+    w.metric("drone_command_queue", "gauge", "Vehicle commands waiting", [(None, command_executor.pending())])
+
+    w.histogram("drone_joystick_latency_seconds", "Joystick to autopilot latency per hop",
+                [({"hop": h}, latency_tracer.hops[h]) for h in LatencyTracer.HOPS])
+    w.metric("drone_joystick_frames_total", "counter", "Joystick frames accepted / sent as setpoints", [
+        ({"result": "accepted"}, latency_tracer.accepted),
+        ({"result": "traced"}, latency_tracer.traced),
+    ])
+
+    link = state.link
+    w.metric("drone_link_connected", "gauge", "Vehicle link is up", [(None, link.state == "connected")])
+    w.metric("drone_link_reconnects_total", "counter", "Reconnects after heartbeat loss", [(None, link.reconnects)])
+    w.metric("drone_link_last_outage_seconds", "gauge", "Duration of the last link outage",
+             [(None, link.last_outage_s)])
+    lq = link_quality.detail or {}
+    hb = lq.get("heartbeat") or {}
+    w.metric("drone_heartbeat_age_seconds", "gauge", "Time since the last autopilot heartbeat",
+             [(None, hb["age_ms"] / 1000.0 if "age_ms" in hb else None)])
+    w.metric("drone_heartbeat_jitter_seconds", "gauge", "Heartbeat inter-arrival standard deviation",
+             [(None, hb["jitter_ms"] / 1000.0 if "jitter_ms" in hb else None)])
+    w.metric("drone_mavlink_bytes_per_second", "gauge", "MAVLink byte rate over the link stats window", [
+        ({"direction": "rx"}, lq.get("rx_bps")),
+        ({"direction": "tx"}, lq.get("tx_bps")),
+    ])
+    w.metric("drone_mavlink_packets_lost_total", "counter", "MAVLink sequence gaps since connect",
+             [(None, link_quality.lost)])
+    counts = dict(link_quality.msg_counts)
+    w.metric("drone_mavlink_messages_total", "counter", "MAVLink messages received by type",
+             [({"type": k}, counts[k]) for k in sorted(counts)])
+    return w.text()
+
+class PrometheusHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.set_header("Cache-Control","no-cache")
+        self.write(render_metrics())
+
+# (version, gzip 后的 status_json), 仅 IOLoop 线程使用
+_status_gzip = (None, None)
+
+def status_gzip(snap):
+    """每个状态版本只压缩一次"""
+    global _status_gzip
+    version, data = _status_gzip
+    if version != snap.version:
+        c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        data = c.compress(snap.status_json) + c.flush()
+        _status_gzip = (snap.version, data)
+    return data
+
+
+# ========== 状态快照: 每个 tick 采集并编码一次 ==========
+
+# version: 状态版本号, 仅在 status 内容变化时 +1 (/api/status 的 ETag)
+# status: get_basic_status() 字典 (只读)
+# telemetry: 遥测包字典 (只读, 供增量编码比较)
+# status_json: /api/status 响应体 (bytes), 同一 version 复用
+# telemetry_json: /ws/telemetry 推送帧 (bytes), 所有客户端共用
+StatusSnapshot = collections.namedtuple('StatusSnapshot', 'ts version status telemetry status_json telemetry_json')
+
+latest_snapshot = None
+# telemetry_loop 与 HTTP 处理都可能采集快照, 版本号比较+递增需要串行
+_snapshot_lock = threading.Lock()
+
+def take_snapshot():
+    """采集一次状态并只序列化一次; 整体替换 latest_snapshot (引用赋值是原子的)"""
+    global latest_snapshot
+    st = get_basic_status()
+    now = time.time()
+    pkt = {
+        "type": "telemetry",
+        "mode": st.get("mode"),
+        "armed": st.get("armed"),
+        "altitude": st.get("altitude"),
+        "groundspeed": st.get("groundspeed"),
+        "heading": st.get("heading"),
+        "attitude": st.get("attitude"),  # 添加姿态信息
+        "battery": st.get("battery"),
+        "takeoff_in_progress": st.get("takeoff_in_progress"),
+        "takeoff_target_alt": st.get("takeoff_target_alt"),
+        "cmd_age_ms": cmd_age_ms(),  # 计算控制延迟
+        "link": st.get("link"),
+        "link_quality": link_quality.summary,
+        "latency": latency_tracer.summary,
+        "timestamp": int(now*1000)
+    }
+    telemetry_json = tornado.escape.utf8(json.dumps(pkt))
+    with _snapshot_lock:
+        prev = latest_snapshot
+        if prev is not None and not _status_changed(prev.status, st):
+            # 状态未变化: 沿用版本号和已编码的响应体
+            snap = StatusSnapshot(now, prev.version, prev.status, pkt, prev.status_json, telemetry_json)
+        else:
+            version = prev.version + 1 if prev is not None else 1
+            body = dict(st)
+            body['ok'] = True
+            body['version'] = version
+            snap = StatusSnapshot(now, version, st, pkt,
+                                  tornado.escape.utf8(json.dumps(body)), telemetry_json)
+        latest_snapshot = snap
+    if (prev is None or snap.version != prev.version) and status_watchers.active():
+        call_on_ioloop(status_watchers.publish, snap)
+    return snap
+
+def _status_changed(old, new):
+    """
+    逐字段比较状态; 数值字段变化不超过 TELEM_DEADBANDS 视为未变化,
+    静止时的高度 / 姿态 / 电压噪声不会产生新版本 (ETag / 长轮询 / SSE 只跟随真实变化).
+    比较对象是上一个版本的状态, 小变化累积超过死区后仍会出新版本.
+    """
+    if old == new:
+        return False
+    a, b = _flatten(old), _flatten(new)
+    if set(a) != set(b):
+        return True
+    for k, v in b.items():
+        if _beyond_deadband(a[k], v, TELEM_DEADBANDS.get(k)):
+            return True
+    return False
+
+def current_snapshot():
+    """返回最近快照; 超过 STATUS_MAX_AGE (如遥测线程未运行) 时就地重新采集"""
+    snap = latest_snapshot
+    if snap is None or time.time() - snap.ts > STATUS_MAX_AGE:
+        snap = take_snapshot()
+    return snap
+
+class StatusWatchers(object):
+    """
+    状态版本变化的订阅者: /api/status?wait= 长轮询与 /api/events SSE 连接.
+    take_snapshot 产生新版本时经 IOLoop 调用 publish; mode / armed / 起降标志变化时
+    refresh_soon 立即补采一次快照. 除 refresh_soon 外仅在 IOLoop 线程使用.
+    """
+
+    def __init__(self):
+        self._futures = []
+        self.streams = set()
+        self._refresh_scheduled = False
+
+    def active(self):
+        return bool(self._futures or self.streams)
+
+    def wait(self):
+        f = tornado.concurrent.Future()
+        self._futures.append(f)
+        return f
+
+    def discard(self, f):
+        if f in self._futures:
+            self._futures.remove(f)
+
+    def publish(self, snap):
+        futures, self._futures = self._futures, []
+        for f in futures:
+            if not f.done():
+                f.set_result(snap)
+        for h in list(self.streams):
+            h.push(snap)
+
+    def refresh_soon(self):
+        """任意线程: 有订阅者时在 IOLoop 上补采一次快照 (多次请求合并为一次)"""
+        if not self.active() or self._refresh_scheduled:
+            return
+        self._refresh_scheduled = True
+        call_on_ioloop(self._refresh)
+
+    def _refresh(self):
+        self._refresh_scheduled = False
+        take_snapshot()
+
+status_watchers = StatusWatchers()
+
+class EventsHandler(tornado.web.RequestHandler):
+    """
+    SSE: 连接后先推送当前状态 (Last-Event-ID 与当前版本相同时跳过), 之后每个新版本一条
+    event: status. 慢客户端只保留最新一条未发送的状态 (latest-wins).
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.set_header("Content-Type","text/event-stream")
+        self.set_header("Cache-Control","no-cache")
+        self.set_header("X-Accel-Buffering","no")
+        self._sent_version = self.request.headers.get("Last-Event-ID")
+        self._flushing = False
+        self._pending = None
+        self._closed = tornado.concurrent.Future()
+        self._keepalive = tornado.ioloop.PeriodicCallback(self._send_keepalive, SSE_KEEPALIVE * 1000)
+        status_watchers.streams.add(self)
+        self._keepalive.start()
+        log("SSE client connected (%d)" % len(status_watchers.streams))
+        self.push(current_snapshot())
+        yield self._closed
+
+    def push(self, snap):
+        if str(snap.version) == self._sent_version:
+            return
+        if self._flushing:
+            self._pending = snap
+            return
+        self._sent_version = str(snap.version)
+        self.write(tornado.escape.utf8("id: %d\nevent: status\ndata: " % snap.version))
+        self.write(snap.status_json)
+        self.write(b"\n\n")
+        self._flush()
+
+    def _send_keepalive(self):
+        if not self._flushing:
+            self.write(b": keepalive\n\n")
+            self._flush()
+
+    def _flush(self):
+        self._flushing = True
+        try:
+            self.flush().add_done_callback(self._on_flushed)
+        except Exception:
+            self.on_connection_close()
+
+    def _on_flushed(self, f):
+        self._flushing = False
+        if f.exception() is not None:
+            self.on_connection_close()
+            return
+        snap, self._pending = self._pending, None
+        if snap is not None:
+            self.push(snap)
+
+    def on_connection_close(self):
+        if self in status_watchers.streams:
+            status_watchers.streams.discard(self)
+            self._keepalive.stop()
+            log("SSE client disconnected (%d)" % len(status_watchers.streams))
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+class TelemetryDelta(object):
+    """
+    增量遥测编码器 (仅在 IOLoop 线程使用).
+    所有 delta 客户端共享同一基线 (baseline: 最近一次发出的各字段值),
+    每个 tick 只比较/编码一次:
+      关键帧 {"type":"telemetry","keyframe":true,"seq":N, ...完整字段}
+      增量帧 {"type":"telemetry_delta","seq":N,"timestamp":...,"changed":{...}}
+    客户端按 seq 连续应用增量帧; 新连接或发生丢帧时先收到当前基线的关键帧.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.baseline = None
+        self._base_pkt = None
+        self._last_key = 0.0
+        self._key_frame = None
+
+    def ready(self):
+        return self.baseline is not None
+
+    def update(self, pkt, now):
+        """输入完整遥测包, 返回要广播的 Frame, 无变化时返回 None"""
+        flat = _flatten(pkt)
+        if self.baseline is None or now - self._last_key >= TELEM_KEYFRAME_INTERVAL:
+            self.seq += 1
+            self.baseline = flat
+            self._base_pkt = pkt
+            self._last_key = now
+            self._key_frame = None
+            return self.keyframe()
+
+        base = self.baseline
+        changed = {}
+        for k, v in flat.items():
+            if k in TELEM_DELTA_SKIP:
+                continue
+            old = base.get(k, _ABSENT)
+            if old is _ABSENT or _beyond_deadband(old, v, TELEM_DEADBANDS.get(k)):
+                changed[k] = v
+        # 基线中有而新包中没有的键: dict 变为 None (attitude.roll -> attitude) 或反之, 旧键从基线删除;
+        # 没有替代键时 (字段整体消失) 报告为 None
+        removed = {}
+        for k in [k for k in base if k not in flat]:
+            del base[k]
+            if not _replaced(k, flat):
+                removed[k] = None
+        if not changed and not removed:
+            return None
+        self.seq += 1
+        base.update(changed)
+        changed.update(removed)
+        self._base_pkt = None
+        self._key_frame = None
+        return Frame({
+            "type": "telemetry_delta",
+            "seq": self.seq,
+            "timestamp": pkt.get("timestamp"),
+            "changed": _unflatten(changed),
+        }, "telemetry_delta")
+
+    def keyframe(self):
+        """当前基线对应的关键帧 (缓存到基线下一次变化)"""
+        if self._key_frame is None:
+            pkt = dict(self._base_pkt) if self._base_pkt is not None else _unflatten(self.baseline)
+            pkt["type"] = "telemetry"
+            pkt["keyframe"] = True
+            pkt["seq"] = self.seq
+            self._key_frame = Frame(pkt, "telemetry_key")
+        return self._key_frame
+
+_ABSENT = object()
+
+def _replaced(key, flat):
+    """key 是否被新包中的父键 ("a.b" -> "a") 或子键 ("a" -> "a.b") 取代"""
+    parts = key.split(".")
+    for i in range(1, len(parts)):
+        if ".".join(parts[:i]) in flat:
+            return True
+    prefix = key + "."
+    for k in flat:
+        if k.startswith(prefix):
+            return True
+    return False
+
+def _flatten(d, prefix=""):
+    """{"attitude":{"roll":..}} -> {"attitude.roll":..}"""
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, prefix + k + "."))
+        else:
+            out[prefix + k] = v
+    return out
+
+def _unflatten(flat):
+    out = {}
+    for k, v in flat.items():
+        node = out
+        parts = k.split(".")
+        for p in parts[:-1]:
+            nxt = node.get(p)
+            if not isinstance(nxt, dict):
+                nxt = node[p] = {}
+            node = nxt
+        node[parts[-1]] = v
+    return out
+
+def _beyond_deadband(old, new, band):
+    if band is None or old is None or new is None or isinstance(new, bool):
+        return old != new
+    try:
+        return abs(float(new) - float(old)) > band
+    except (TypeError, ValueError):
+        return old != new
+
+telemetry_delta = TelemetryDelta()
+
+class LinkFrames(object):
+    """
+    enc=struct 客户端的链路帧 (仅 IOLoop 线程使用): 固定布局只带链路状态,
+    link / link_quality / latency 相对上次发出的值变化超出 TELEM_DEADBANDS 时生成一帧 {"type":"link",...}.
+    """
+
+    def __init__(self):
+        self.last = None
+        self.frame = None   # 最近一帧, 新连接的客户端先收到它
+
+    def update(self, pkt):
+        cur = dict((k, pkt.get(k)) for k in TELEM_LINK_FIELDS)
+        if self.last is not None and not _status_changed(self.last, cur):
+            return None
+        self.last = cur
+        obj = dict(cur)
+        obj["type"] = "link"
+        obj["timestamp"] = pkt.get("timestamp")
+        self.frame = Frame(obj, "link")
+        return self.frame
+
+link_frames = LinkFrames()
+
+# ========== 字段订阅: 共享字段缓存 ==========
+
+# 可订阅字段 -> 读取函数 (读取 vehicle_record, 不访问 DroneKit 属性)
+TELEM_FIELD_READERS = {
+    "mode": lambda: vehicle_record.mode,
+    "armed": lambda: vehicle_record.armed,
+    "altitude": lambda: vehicle_record.altitude,
+    "groundspeed": lambda: vehicle_record.groundspeed,
+    "heading": lambda: vehicle_record.heading,
+    "attitude": lambda: vehicle_record.attitude,
+    "battery": lambda: vehicle_record.battery,
+    "takeoff_in_progress": lambda: state.flight.takeoff_in_progress,
+    "takeoff_target_alt": lambda: state.flight.takeoff_target_alt,
+    "cmd_age_ms": cmd_age_ms,
+    "link": lambda: dict(state.link._asdict()),
+    "link_quality": lambda: link_quality.summary,
+    "latency": lambda: latency_tracer.summary,
+}
+
+# 未连接飞控时仍可读取的字段
+TELEM_LINK_FIELDS = ("link", "link_quality", "latency")
+
+class FieldCache(object):
+    """
+    订阅推送共用的字段缓存 (仅 IOLoop 线程使用).
+    每个字段最多每 FIELD_CACHE_TTL 读取一次; 相同字段组在同一批数据上只编码一次,
+    多个客户端以相同字段/频率订阅时共用同一个 Frame.
+    """
+
+    def __init__(self):
+        self._values = {}   # field -> (ts, value)
+        self._frames = {}   # fields -> (stamp, Frame)
+
+    def get(self, name, now):
+        ent = self._values.get(name)
+        if ent is None or now - ent[0] >= FIELD_CACHE_TTL:
+            try:
+                v = TELEM_FIELD_READERS[name]() if state.vehicle or name in TELEM_LINK_FIELDS else None
+            except:
+                v = None
+            ent = (now, v)
+            self._values[name] = ent
+        return ent
+
+    def frame(self, fields):
+        """{"type":"telemetry_sub","timestamp":ms, <field>: <value>...}"""
+        now = time.time()
+        ents = [self.get(f, now) for f in fields]
+        stamp = max(e[0] for e in ents)
+        cached = self._frames.get(fields)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        pkt = {"type": "telemetry_sub", "timestamp": int(stamp * 1000)}
+        for f, e in zip(fields, ents):
+            pkt[f] = e[1]
+        frame = Frame(pkt, "telemetry_sub")
+        self._frames[fields] = (stamp, frame)
+        return frame
+
+field_cache = FieldCache()
+
+# ========== MAVLink 高频消息 (ATTITUDE / GLOBAL_POSITION_INT / VFR_HUD) ==========
+
+# 消息名 -> 字段提取 (换算为与遥测一致的 SI 单位)
+MAV_STREAM_MESSAGES = {
+    'ATTITUDE': lambda m: {
+        "roll": m.roll, "pitch": m.pitch, "yaw": m.yaw,
+        "rollspeed": m.rollspeed, "pitchspeed": m.pitchspeed, "yawspeed": m.yawspeed,
+    },
+    'GLOBAL_POSITION_INT': lambda m: {
+        "lat": m.lat / 1e7, "lon": m.lon / 1e7,
+        "alt": m.alt / 1000.0, "relative_alt": m.relative_alt / 1000.0,
+        "vx": m.vx / 100.0, "vy": m.vy / 100.0, "vz": m.vz / 100.0,
+        "hdg": m.hdg / 100.0 if m.hdg != 65535 else None,
+    },
+    'VFR_HUD': lambda m: {
+        "airspeed": m.airspeed, "groundspeed": m.groundspeed, "heading": m.heading,
+        "throttle": m.throttle, "alt": m.alt, "climb": m.climb,
+    },
+}
+
+# recv_time: 服务器收到时间; time_boot_ms: 飞控时钟 (VFR_HUD 无此字段, 为 None)
+MavSample = collections.namedtuple('MavSample', 'recv_time time_boot_ms fields')
+
+class MavlinkStore(object):
+    """
+    记录飞控推送的每条高频消息 (DroneKit 消息线程中更新, 每条消息一次引用替换),
+    保留飞控时间戳 time_boot_ms, 供 HUD 按飞控时钟做平滑/对齐.
+    有 stream 客户端时, 新消息合并为一次 add_callback 投递到 IOLoop,
+    每条消息只编码一次, 所有订阅该消息的客户端共用.
+    """
+
+    def __init__(self):
+        self.latest = {}    # name -> MavSample
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._flush_scheduled = False
+
+    def attach(self, v):
+        for name in MAV_STREAM_MESSAGES:
+            v.add_message_listener(name, self._listener)
+
+    def _listener(self, v, name, msg):
+        try:
+            fields = MAV_STREAM_MESSAGES[name](msg)
+        except Exception:
+            return
+        self.latest[name] = MavSample(time.time(), getattr(msg, 'time_boot_ms', None), fields)
+        if not stream_clients:
+            return
+        with self._lock:
+            self._dirty.add(name)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        call_on_ioloop(self._flush)
+
+    def _flush(self):
+        """IOLoop 线程: 推送自上次 flush 以来更新过的消息 (每种只推最新一条)"""
+        with self._lock:
+            names, self._dirty = self._dirty, set()
+            self._flush_scheduled = False
+        for name in names:
+            sample = self.latest.get(name)
+            if sample is None:
+                continue
+            pkt = {
+                "type": "mav",
+                "msg": name,
+                "time_boot_ms": sample.time_boot_ms,
+                "recv_ms": int(sample.recv_time * 1000),
+            }
+            pkt.update(sample.fields)
+            key = "mav:" + name
+            frame = Frame(pkt, key)
+            for c in list(stream_clients):
+                if name in c.streams:
+                    c.send_frame(frame, key)
+
+mavlink_store = MavlinkStore()
+
+# ========== 链路质量 (MAVLink 序号 / 心跳 / 流量 / RADIO_STATUS) ==========
+
+RADIO_STATUS_FIELDS = ('rssi', 'remrssi', 'txbuf', 'noise', 'remnoise', 'rxerrors', 'fixed')
+# 进入遥测的字段; rxerrors / fixed 是电台的累计计数, heartbeat age_ms 逐 tick 变化, 只在 /api/metrics
+RADIO_STATUS_ROLLING = ('rssi', 'remrssi', 'txbuf', 'noise', 'remnoise')
+LINK_HEARTBEAT_ROLLING = ('interval_ms', 'jitter_ms', 'max_ms')
+
+# 滚动窗口采样点: 本地时间与各累计计数
+LinkSample = collections.namedtuple('LinkSample', 'ts rx_bytes tx_bytes rx_errors received lost')
+
+class LinkQuality(object):
+    """
+    MAVLink 链路质量统计.
+    DroneKit 消息线程中只做计数 (每条消息按 (sysid, compid) 比较序号, 缺口计为丢包);
+    telemetry_loop 每个 tick 调用 sample() 采样累计值, 计算最近 LINK_STATS_WINDOW 秒的
+    字节率 / 丢包率, 结果整体替换 summary (滚动值, 遥测) 与 detail (另含累计计数 / 各组件 / age,
+    /api/metrics 与 /metrics); 两者均为只读字典.
+    每次连接 (attach) 重新开始计数, 断链期间的序号跳变不计入丢包.
+    """
+
+    def __init__(self):
+        self.summary = None
+        self.detail = None
+        self.msg_counts = {}    # 消息类型 -> 累计条数 (跨重连累计, 供 /metrics)
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, v):
+        self.vehicle = v
+        self.components = {}    # (sysid, compid) -> [last_seq, received, lost]
+        self.received = 0
+        self.lost = 0
+        self.intervals = collections.deque(maxlen=LINK_HEARTBEAT_SAMPLES)
+        self.last_heartbeat = None
+        self.radio = None       # (recv_time, {RADIO_STATUS 字段})
+        self.samples = collections.deque()
+
+    def attach(self, v):
+        with self._lock:
+            self._reset(v)
+        v.add_message_listener('*', self._listener)
+        v.add_message_listener('RADIO_STATUS', self._radio_listener)
+
+    def _listener(self, v, name, msg):
+        if v is not self.vehicle:
+            return
+        self.msg_counts[name] = self.msg_counts.get(name, 0) + 1
+        if name == 'BAD_DATA':
+            return
+        try:
+            key = (msg.get_srcSystem(), msg.get_srcComponent())
+            seq = msg.get_seq()
+        except Exception:
+            return
+        comp = self.components.get(key)
+        if comp is None:
+            with self._lock:
+                self.components[key] = [seq, 1, 0]
+            self.received += 1
+            return
+        gap = (seq - comp[0] - 1) % 256
+        comp[0] = seq
+        comp[1] += 1
+        self.received += 1
+        if gap:
+            comp[2] += gap
+            self.lost += gap
+
+    def _radio_listener(self, v, name, msg):
+        fields = {}
+        for f in RADIO_STATUS_FIELDS:
+            fields[f] = getattr(msg, f, None)
+        self.radio = (time.time(), fields)
+
+    def heartbeat(self, now):
+        """飞控 HEARTBEAT 到达 (monotonic), 由 _heartbeat_listener 调用"""
+        last = self.last_heartbeat
+        self.last_heartbeat = now
+        if last is not None:
+            self.intervals.append(now - last)
+
+    def sample(self):
+        """采样累计计数并更新 summary (telemetry_loop 线程)"""
+        v = self.vehicle
+        now = monotonic()
+        mav = getattr(getattr(getattr(v, '_handler', None), 'master', None), 'mav', None)
+        cur = LinkSample(now,
+                         getattr(mav, 'total_bytes_received', 0),
+                         getattr(mav, 'total_bytes_sent', 0),
+                         getattr(mav, 'total_receive_errors', 0),
+                         self.received, self.lost)
+        samples = self.samples
+        samples.append(cur)
+        while len(samples) > 2 and now - samples[1].ts >= LINK_STATS_WINDOW:
+            samples.popleft()
+        first = samples[0]
+        dt = now - first.ts
+        total = (cur.received - first.received) + (cur.lost - first.lost)
+
+        with self._lock:
+            components = list(self.components.items())
+        comps = {}
+        for (sysid, compid), (last_seq, received, lost) in components:
+            comps["%d:%d" % (sysid, compid)] = {
+                "received": received,
+                "lost": lost,
+                "loss_pct": round(100.0 * lost / (received + lost), 2),
+            }
+
+        intervals = list(self.intervals)
+        hb = None
+        if intervals:
+            mean = sum(intervals) / len(intervals)
+            var = sum((x - mean) ** 2 for x in intervals) / len(intervals)
+            hb = {
+                "interval_ms": int(mean * 1000),
+                "jitter_ms": int(math.sqrt(var) * 1000),
+                "max_ms": int(max(intervals) * 1000),
+            }
+        if self.last_heartbeat is not None:
+            hb = hb or {}
+            hb["age_ms"] = int((now - self.last_heartbeat) * 1000)
+
+        radio = None
+        if self.radio is not None:
+            recv_time, fields = self.radio
+            radio = dict(fields)
+            radio["age_ms"] = int((time.time() - recv_time) * 1000)
+
+        if v is None:
+            self.summary = self.detail = None
+            return None
+        # 遥测只带滚动值 (有死区), 累计计数 / 各类 age 每个 tick 都变, 只放在 /api/metrics
+        summary = {
+            "rx_bps": int((cur.rx_bytes - first.rx_bytes) / dt) if dt > 0 else None,
+            "tx_bps": int((cur.tx_bytes - first.tx_bytes) / dt) if dt > 0 else None,
+            "rx_errors": cur.rx_errors - first.rx_errors,
+            "loss_pct": round(100.0 * (cur.lost - first.lost) / total, 2) if total else None,
+            "heartbeat": dict((k, hb[k]) for k in LINK_HEARTBEAT_ROLLING if k in hb) if hb else None,
+            "radio": dict((k, radio[k]) for k in RADIO_STATUS_ROLLING) if radio else None,
+        }
+        detail = dict(summary)
+        detail.update({
+            "window_s": round(dt, 1),
+            "received": cur.received,
+            "lost": cur.lost,
+            "components": comps,
+            "heartbeat": hb,
+            "radio": radio,
+        })
+        self.detail = detail
+        self.summary = summary
+        return summary
+
+link_quality = LinkQuality()
+
+def broadcast_telemetry(snap):
+    """在 IOLoop 线程分发遥测: 完整帧与增量帧每种编码各序列化一次, 所有客户端共用"""
+    t0 = monotonic()
+    full = Frame(snap.telemetry, "telemetry", snap.telemetry_json)
+    delta = telemetry_delta.update(snap.telemetry, snap.ts)
+    link = link_frames.update(snap.telemetry)
+    for c in list(telemetry_clients):
+        if c.subs:
+            # 已按字段订阅的客户端由各自的 PeriodicCallback 推送
+            continue
+        if c.delta:
+            if delta is not None:
+                c.send_frame(delta)
+        else:
+            c.send_frame(full)
+            if link is not None and c.codec.name == "struct":
+                c.send_frame(link, "link")
+    telemetry_fanout.add((monotonic() - t0) * 1000.0)
+
+telemetry_fanout = LatencyHistogram(IOLOOP_BUCKETS_MS)
 
 
 # ========== 循环线程: 发送速度 / 推送遥测 ==========
 def control_loop():
-    global last_velocity_cmd, landing_in_progress
     while True:
+        # 所有分支都按同一截止时间节拍运行 (未解锁时只是空转读取 armed)
+        control_scheduler.wait()
         try:
+            vehicle = state.vehicle
             if vehicle and vehicle.armed:
                 # 起飞或降落过程中完全停止速度控制，避免冲突
-                if takeoff_in_progress or landing_in_progress:
-                    time.sleep(0.1)
+                flight = state.flight
+                if flight.takeoff_in_progress or flight.landing_in_progress:
                     continue
                     
                 mode_name = ""
@@ -557,94 +2792,336 @@ def control_loop():
                     mode_name = vehicle.mode.name
                 except:
                     pass
-                if mode_name in ("GUIDED","GUIDED_NOGPS","BRAKE","POSHOLD"):
-                    age = time.time() - last_joystick_time
-                    cmd = last_velocity_cmd
-                    if age > VELOCITY_TIMEOUT:
-                        # 超时清零
-                        send_ned_velocity(0.0, 0.0, 0.0, 0.0)
-                    else:
-                        send_ned_velocity(cmd["vx"], cmd["vy"], cmd["vz"], cmd["yaw_rate"])
+                if mode_name in VELOCITY_MODES:
+                    joy = state.joystick
+                    cmd = joy.cmd
+                    if time.time() - joy.ts > VELOCITY_TIMEOUT:
+                        # 超时清零 (保持坐标系 / type_mask, yaw_rate 归零即停止转向)
+                        cmd = velocity_cmd(0.0, 0.0, 0.0, 0.0, cmd.frame, cmd.type_mask)
+                    # 即时转发刚发过同一设定点时跳过本 tick, 这里只负责保活
+                    sent = state.sent
+                    if (sent.forward and cmd == sent.cmd and
+                            monotonic() - sent.ts < control_scheduler.period):
+                        continue
+                    send_setpoint(cmd, recv_ts=joy.ts if cmd is joy.cmd else None)
                 elif mode_name == "LAND":
                     # 降落过程中检测是否已降落完成
                     if safe_alt() <= 0.2:  # 高度小于0.2米认为降落完成
-                        if landing_in_progress:
-                            landing_in_progress = False
+                        if flight.landing_in_progress:
+                            state.update_flight(landing_in_progress=False)
                             log("[LAND] 降落完成，重置降落标志")
-            else:
-                # 未解锁时也稍作等待，减少CPU占用
-                time.sleep(0.1)
-            time.sleep(1.0/CONTROL_HZ)
         except Exception as e:
-            # 避免线程退出
+            # 避免线程退出; 退避后重新对齐节拍
+            log("[CONTROL] 异常: %s" % e)
             time.sleep(0.5)
+            control_scheduler.reset()
 
 def telemetry_loop():
     while True:
         try:
-            if telemetry_clients and vehicle:
-                st = get_basic_status()
-                # 计算控制延迟
-                cmd_age_ms = int((time.time() - last_joystick_time) * 1000) if last_joystick_time > 0 else -1
-                pkt = {
-                    "type": "telemetry",
-                    "mode": st.get("mode"),
-                    "armed": st.get("armed"),
-                    "altitude": st.get("altitude"),
-                    "groundspeed": st.get("groundspeed"),
-                    "heading": st.get("heading"),
-                    "attitude": st.get("attitude"),  # 添加姿态信息
-                    "battery": st.get("battery"),
-                    "takeoff_in_progress": st.get("takeoff_in_progress"),
-                    "takeoff_target_alt": st.get("takeoff_target_alt"),
-                    "cmd_age_ms": cmd_age_ms,
-                    "timestamp": int(time.time()*1000)
-                }
-                msg = json.dumps(pkt)
-                dead = []
-                for c in telemetry_clients:
-                    try:
-                        c.write_message(msg)
-                    except:
-                        dead.append(c)
-                for d in dead:
-                    if d in telemetry_clients:
-                        telemetry_clients.remove(d)
+            # 无遥测客户端时也刷新快照, 供 /api/status / diag 直接复用;
+            # 未连接飞控时同样推送, 客户端可看到 link 连接进度
+            link_quality.sample()
+            latency_tracer.sample()
+            snap = take_snapshot()
+            if telemetry_clients:
+                # write_message 不是线程安全的, 交给 IOLoop 线程分发
+                call_on_ioloop(broadcast_telemetry, snap)
             time.sleep(TELEM_INTERVAL)
-        except Exception:
+        except Exception as e:
+            log("[TELEM] 异常: %s" % e)
             time.sleep(1.0)
 
+# ========== 参数表缓存 ==========
+
+class ParamCache(object):
+    """
+    飞控参数表的磁盘缓存. ArduPilot 不提供参数表哈希 (_HASH_CHECK 只有 PX4 回复),
+    因此按 AUTOPILOT_VERSION 中的 自驾仪类型 / 固件版本 (含 git 版本) / 飞控板型号与 UID 分文件,
+    并以 PARAM_VALUE 中的参数个数 (param_count) 校验.
+    命中后把缓存填入 DroneKit 参数表并标记 'parameters' 就绪, 不必等待几十秒的串口下载;
+    这些只是临时值 (provisional): DroneKit 仍在后台下载, 收到的每个参数直接覆盖缓存值,
+    下载完成 ('parameters' 通知) 后整表写回缓存.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.provisional = False    # 当前参数表是否仍含未经下载确认的缓存值 (/api/status params_provisional)
+        self._identity = None
+        self._count = None
+        self._identity_event = threading.Event()
+        self._count_event = threading.Event()
+
+    def attach(self, v):
+        if not self.directory:
+            return
+        self.provisional = False
+        self._identity = None
+        self._count = None
+        self._identity_event.clear()
+        self._count_event.clear()
+        v.add_message_listener('AUTOPILOT_VERSION', self._on_autopilot_version)
+        v.add_message_listener('PARAM_VALUE', self._on_param_value)
+        v.add_attribute_listener('parameters', self._on_parameters_loaded)
+        self._spawn(self._load, v)
+
+    def _spawn(self, fn, v):
+        # 等待飞控回复不能占用 DroneKit 消息线程
+        th = threading.Thread(target=fn, args=(v,))
+        th.daemon = True
+        th.start()
+
+    def _on_autopilot_version(self, v, name, msg):
+        uid2 = getattr(msg, 'uid2', None)
+        self._identity = "%s-%08x-%s-%x-%s" % (
+            getattr(v, '_autopilot_type', None), msg.flight_sw_version,
+            _hex(getattr(msg, 'flight_custom_version', b'')), msg.board_version,
+            _hex(uid2) if uid2 and any(bytearray(uid2)) else "%016x" % msg.uid)
+        self._identity_event.set()
+
+    def _on_param_value(self, v, name, msg):
+        # DroneKit 的后台下载 / 下面的按索引请求都会带回 param_count
+        if self._count is None:
+            self._count = msg.param_count
+            self._count_event.set()
+
+    def _probe(self, v):
+        """请求 AUTOPILOT_VERSION 与第 0 个参数, 返回 (标识, 参数个数); 超时未知的项为 None"""
+        mav = v._handler.master.mav
+        target = v._handler.target_system
+        if not self._identity_event.is_set():
+            mav.command_long_send(target, 0, MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES, 0, 1, 0, 0, 0, 0, 0, 0)
+        if not self._count_event.is_set():
+            mav.param_request_read_send(target, 0, b"", 0)
+        deadline = time.time() + PARAM_PROBE_TIMEOUT
+        self._identity_event.wait(max(0.0, deadline - time.time()))
+        self._count_event.wait(max(0.0, deadline - time.time()))
+        return self._identity, self._count
+
+    def _path(self, identity):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', identity) + ".json")
+
+    def _load(self, v):
+        try:
+            identity, count = self._probe(v)
+            if identity is None:
+                log("[PARAM] 飞控未回复 AUTOPILOT_VERSION, 不使用参数缓存")
+                return
+            if count is None:
+                log("[PARAM] 飞控未回复 PARAM_VALUE, 不使用参数缓存")
+                return
+            path = self._path(identity)
+            if not os.path.exists(path):
+                log("[PARAM] 无参数缓存 (%s), 等待后台下载" % os.path.basename(path))
+                return
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("count") != count or len(data.get("params", ())) != count:
+                log("[PARAM] 参数缓存已过期 (参数个数 %s != %s), 等待后台下载" % (data.get("count"), count))
+                return
+            if 'parameters' in v._ready_attrs:
+                return  # 后台下载已先完成
+            # 只补缺: 已经下载到的参数保持飞控的当前值
+            params = v._params_map
+            for k, val in data["params"].items():
+                params.setdefault(k, val)
+            self.provisional = True
+            v._ready_attrs.add('parameters')
+            status_watchers.refresh_soon()
+            log("[PARAM] 从缓存加载 %d 个参数 (%s, 临时值, 后台下载完成后覆盖)" % (
+                count, os.path.basename(path)))
+        except Exception as e:
+            log("[PARAM] 读取参数缓存失败: %s" % e)
+
+    def _on_parameters_loaded(self, v, name, value):
+        self._spawn(self._save, v)
+
+    def _save(self, v):
+        try:
+            identity, count = self._probe(v)
+            if identity is None:
+                return
+            params = dict(v._params_map)
+            if count is not None and len(params) != count:
+                log("[PARAM] 参数表不完整 (%d/%d), 不写缓存" % (len(params), count))
+                return
+            if self.provisional:
+                self.provisional = False
+                status_watchers.refresh_soon()
+            path = self._path(identity)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"identity": identity, "count": len(params), "saved": time.time(),
+                           "params": params}, f)
+            os.rename(tmp, path)
+            log("[PARAM] 参数缓存已更新 (%d 个, %s)" % (len(params), os.path.basename(path)))
+        except Exception as e:
+            log("[PARAM] 写入参数缓存失败: %s" % e)
+
+def _hex(data):
+    """uint8[] 字段 (pymavlink 可能给出 list / bytes / str) -> 十六进制字符串"""
+    try:
+        return binascii.hexlify(bytearray(data)).decode('ascii')
+    except (TypeError, ValueError):
+        return str(data)
+
+param_cache = ParamCache(PARAM_CACHE_DIR)
+
 # ========== 连接飞控 & 启动服务 ==========
 
 def connect_vehicle():
     conn = os.environ.get("DRONE_CONN", "/dev/ttyUSB0")
     baud = int(os.environ.get("DRONE_BAUD", "921600"))
+    # wait_ready 传列表时 DroneKit 不会带上 timeout, 所以先连接再单独等待;
+    # 等待失败必须关闭, 否则读线程和串口留在后台, 重试时同一端口被打开两次
     if conn.startswith("udp:") or conn.startswith("tcp:"):
-        print("[SERVER] Connecting to vehicle (blocking): %s" % conn)
-        v = connect(conn, wait_ready=True, timeout=120)
+        print("[SERVER] Connecting to vehicle: %s" % conn)
+        v = connect(conn, wait_ready=False)
     else:
-        print("[SERVER] Connecting to vehicle (blocking): %s baud=%d" % (conn, baud))
-        v = connect(conn, baud=baud, wait_ready=True, timeout=120)
-    print("[SERVER] Connected. Firmware: %s Battery: %s" % (str(v.version), str(v.battery)))
+        print("[SERVER] Connecting to vehicle: %s baud=%d" % (conn, baud))
+        v = connect(conn, baud=baud, wait_ready=False)
+    try:
+        v.wait_ready(*CONNECT_WAIT_READY, timeout=CONNECT_TIMEOUT)
+    except Exception:
+        try:
+            v.close()
+        except Exception as e:
+            log("[LINK] 关闭未就绪的连接异常: %s" % e)
+        raise
+    print("[SERVER] Connected. Firmware: %s Battery: %s" % (firmware_version(v), str(v.battery)))
+    try:
+        v.add_message_listener('HEARTBEAT', _heartbeat_listener)
+    except Exception as e:
+        print("[SERVER] Failed attach HEARTBEAT listener: %s" % e)
     try:
         v.add_message_listener('STATUSTEXT', _statustext_listener)
         print("[SERVER] STATUSTEXT listener attached")
     except Exception as e:
         print("[SERVER] Failed attach STATUSTEXT listener: %s" % e)
+    try:
+        state_waiter.attach(v)
+        print("[SERVER] mode/armed listeners attached")
+    except Exception as e:
+        print("[SERVER] Failed attach mode/armed listeners: %s" % e)
+    try:
+        vehicle_record.attach(v)
+        print("[SERVER] vehicle state listeners attached")
+    except Exception as e:
+        print("[SERVER] Failed attach vehicle state listeners: %s" % e)
+    try:
+        param_cache.attach(v)
+    except Exception as e:
+        print("[SERVER] Failed attach parameter cache: %s" % e)
+    try:
+        v.add_message_listener('TIMESYNC', latency_tracer._timesync_listener)
+    except Exception as e:
+        print("[SERVER] Failed attach TIMESYNC listener: %s" % e)
+    try:
+        link_quality.attach(v)
+        print("[SERVER] link quality listeners attached")
+    except Exception as e:
+        print("[SERVER] Failed attach link quality listeners: %s" % e)
+    try:
+        mavlink_store.attach(v)
+        print("[SERVER] %s listeners attached" % "/".join(sorted(MAV_STREAM_MESSAGES)))
+    except Exception as e:
+        print("[SERVER] Failed attach MAVLink stream listeners: %s" % e)
     return v
 
+def establish_link(lost_at=None):
+    """连接飞控直到成功 (失败后指数退避重试); lost_at 为断链时刻 (monotonic), 首次连接为 None"""
+    attempt = 0
+    delay = CONNECT_RETRY_MIN
+    while True:
+        attempt += 1
+        state.set_link("connecting", attempt)
+        t0 = time.time()
+        try:
+            v = connect_vehicle()
+        except Exception as e:
+            log("[LINK] 第 %d 次连接失败: %s, %.1fs 后重试" % (attempt, e, delay))
+            state.set_link("retry_wait", attempt, str(e))
+            time.sleep(delay)
+            delay = min(delay * 2, CONNECT_RETRY_MAX)
+            continue
+        # 连上即视为收到心跳, 从此刻开始计算超时
+        state.heartbeat = monotonic()
+        state.vehicle = v
+        if lost_at is None:
+            state.set_link("connected", attempt)
+            log("[LINK] 飞控已连接 (第 %d 次尝试, %.1fs)" % (attempt, time.time() - t0))
+        else:
+            outage = monotonic() - lost_at
+            state.set_link("connected", attempt, reconnects=state.link.reconnects + 1,
+                           last_outage_s=round(outage, 1))
+            log("[LINK] 飞控已重新连接 (第 %d 次尝试, 断链 %.1fs)" % (attempt, outage))
+        return
+
+def _close_vehicle(v):
+    """
+    关闭失效的 DroneKit 连接. 放到单独线程, 最多等 LINK_CLOSE_TIMEOUT, 避免卡在已断开的串口/套接字上;
+    重连会重新打开同一端口, 旧读线程未退出时两个读者会互相打乱帧, 所以返回前尽量等它结束.
+    返回是否已在超时内关闭.
+    """
+    def close():
+        try:
+            v.close()
+        except Exception as e:
+            log("[LINK] 关闭旧连接异常: %s" % e)
+    th = threading.Thread(target=close)
+    th.daemon = True
+    th.start()
+    th.join(LINK_CLOSE_TIMEOUT)
+    if th.is_alive():
+        log("[LINK] 旧连接 %.1fs 内未关闭, 仍继续重连 (端口可能被两个读线程共用)" % LINK_CLOSE_TIMEOUT)
+        return False
+    return True
+
+def link_supervisor():
+    """
+    飞控链路监护 (后台线程, 不阻塞 HTTP/WS 启动): 先建立连接, 之后每 LINK_CHECK_INTERVAL
+    检查一次心跳; 超过 HEARTBEAT_TIMEOUT 未收到则丢弃旧连接并重连.
+    WebSocket / UDP 会话不依赖 vehicle 对象, 重连期间保持; 飞控指令在此期间回复未连接.
+    """
+    establish_link()
+    while True:
+        time.sleep(LINK_CHECK_INTERVAL)
+        age = monotonic() - state.heartbeat
+        if age <= HEARTBEAT_TIMEOUT:
+            latency_tracer.timesync(state.vehicle)
+            continue
+        lost_at = state.heartbeat
+        old = state.vehicle
+        # 先摘掉引用, 各循环 / 指令立即看到未连接, 不再向失效连接发送
+        state.vehicle = None
+        state.set_link("lost", 0, "%.1fs 未收到心跳" % age)
+        log("[LINK] %.1fs 未收到心跳, 断开并重连" % age)
+        if old is not None:
+            _close_vehicle(old)
+        establish_link(lost_at)
+
 def make_app():
     return tornado.web.Application([
         (r"/api/status", StatusHandler),
+        (r"/api/metrics", MetricsHandler),
+        (r"/metrics", PrometheusHandler),
+        (r"/api/events", EventsHandler),
         (r"/ws/control", ControlWS),
         (r"/ws/telemetry", TelemetryWS),
     ])
 
 def main():
-    global vehicle
-    vehicle = connect_vehicle()
+    global ioloop, udp_control
+    ioloop = tornado.ioloop.IOLoop.current()
+    command_executor.start()
+    ioloop_lag.start(ioloop)
 
     # 启动后台线程
+    vt = threading.Thread(target=link_supervisor)
+    vt.daemon = True
+    vt.start()
     ct = threading.Thread(target=control_loop)
     ct.daemon = True
     ct.start()
@@ -657,14 +3134,19 @@ def main():
     app.listen(port, address="0.0.0.0")
     log("Server started on 0.0.0.0:%d" % port)
 
+    udp_port = int(os.environ.get("DRONE_UDP_PORT", "0"))
+    if udp_port > 0:
+        udp_control = UdpControlServer(udp_port)
+        udp_control.start(ioloop)
+
     try:
         tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
         print("\n[SERVER] KeyboardInterrupt, exiting...")
     finally:
         try:
-            if vehicle:
-                vehicle.close()
+            if state.vehicle:
+                state.vehicle.close()
         except:
             pass
 